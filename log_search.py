@@ -0,0 +1,229 @@
+#!/usr/bin/env /router/bin/python-2.7.4
+'''
+Search log files for several regular expressions at once. The files are
+scanned in parallel by a pool of processes, each file is mapped in memory
+and searched in one pass for all the patterns. The search stops as soon
+as the caller has what it needs, e.g. the first match of every pattern.
+The result of a file is kept in an index with the size and mtime of the
+file so an unchanged file is not read again for the same patterns.
+Compressed logs (.gz) are read line by line.
+
+Usage:
+log_search.py -p <pattern> [-p <pattern> ...] [-j <jobs>] [-a] <path> ...
+'''
+import os
+import sys
+import re
+import mmap
+import gzip
+import multiprocessing
+from optparse import OptionParser
+from state_files import load_json_file, save_json_file
+
+compiled_patterns = {}
+
+def compile_patterns(patterns):
+    '''
+    Compile the patterns in one regex, the pattern matched is found from
+    the named group of it.
+    '''
+    key = tuple(patterns)
+    if key not in compiled_patterns:
+        compiled_patterns[key] = re.compile('|'.join(
+            ['(?P<p%d>%s)' % (i, pattern)
+             for i, pattern in enumerate(patterns)]), re.M)
+    return compiled_patterns[key]
+
+
+def get_line(data, start, end):
+    line_start = data.rfind('\n', 0, start) + 1
+    line_end = data.find('\n', end)
+    if line_end < 0:
+        line_end = len(data)
+    return data[line_start:line_end]
+
+
+def search_data(regex, count, data, offset, found):
+    '''
+    Search the data for the patterns not found yet. The found dictionary
+    of the pattern index to (offset, line) is updated, returns True once
+    all the patterns are found.
+    '''
+    for match in regex.finditer(data):
+        for i in range(count):
+            if i not in found and match.group('p%d' % i) is not None:
+                found[i] = (offset + match.start(),
+                            get_line(data, match.start(), match.end()))
+        if len(found) == count:
+            return True
+    return False
+
+
+def scan_file(args):
+    '''
+    Get the first match of every pattern in the file as the tuple (path,
+    {pattern index: (offset, line)}). Runs in the worker processes.
+    '''
+    path, patterns = args
+    regex = compile_patterns(patterns)
+    found = {}
+    try:
+        if path.endswith('.gz'):
+            offset = 0
+            f = gzip.open(path)
+            for line in f:
+                if search_data(regex, len(patterns), line, offset, found):
+                    break
+                offset += len(line)
+            f.close()
+        elif os.path.getsize(path):
+            f = open(path, 'rb')
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            search_data(regex, len(patterns), data, 0, found)
+            data.close()
+            f.close()
+    except EnvironmentError:
+        pass
+    return (path, found)
+
+
+def list_files(paths, newer_than=None):
+    '''
+    Get the files of the paths, the directories are walked. The files
+    not modified since newer_than are skipped.
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, fnames in os.walk(path):
+                dirs.sort()
+                files.extend([os.path.join(root, fname)
+                              for fname in sorted(fnames)])
+        else:
+            files.append(path)
+    files = [path for path in files if os.path.isfile(path)]
+    if newer_than:
+        files = [path for path in files
+                 if os.path.getmtime(path) >= newer_than]
+    return files
+
+
+def load_index(index_file):
+    return load_json_file(index_file) or {}
+
+
+def save_index(index_file, index):
+    '''
+    Save the index, the results of the files which do not exist anymore
+    are dropped.
+    '''
+    for key, entries in index.items():
+        for path in entries.keys():
+            if not os.path.exists(path):
+                del entries[path]
+        if not entries:
+            del index[key]
+    save_json_file(index_file, index)
+
+
+def search_logs(paths, patterns, jobs=4, index_file=None, newer_than=None):
+    '''
+    Search the files of the paths for the patterns. Yields (path,
+    {pattern: (offset, line)}) with the first match of each pattern in the
+    file, for the files with a match, in the order the files complete.
+    The search stops when the caller stops iterating. The result of a
+    file is taken from the index_file if the file did not change since
+    it was searched for the same patterns.
+    '''
+    patterns = list(patterns)
+    index = load_index(index_file) if index_file else {}
+    index_key = '\n'.join(patterns)
+    entries = index.setdefault(index_key, {})
+
+    pending = []
+    for path in list_files(paths, newer_than):
+        st = os.stat(path)
+        entry = entries.get(path)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime:
+            if entry[2]:
+                yield (path, dict([(patterns[int(i)], tuple(match))
+                                   for i, match in entry[2].items()]))
+            continue
+        pending.append((path, st))
+
+    stats = dict(pending)
+    pool = None
+    if len(pending) > 1 and jobs > 1:
+        pool = multiprocessing.Pool(min(jobs, len(pending)))
+        completed = pool.imap_unordered(scan_file, [(path, patterns)
+                                                    for path, st in pending])
+    else:
+        completed = (scan_file((path, patterns)) for path, st in pending)
+    try:
+        for path, found in completed:
+            st = stats[path]
+            entries[path] = [st.st_size, st.st_mtime, found]
+            if found:
+                yield (path, dict([(patterns[i], match)
+                                   for i, match in found.items()]))
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        if index_file:
+            save_index(index_file, index)
+
+
+def find_first(paths, patterns, jobs=4, index_file=None, newer_than=None):
+    '''
+    Get the first match found of every pattern in the files of the paths,
+    the search stops once all the patterns are found. Returns {pattern:
+    (path, offset, line)}, None for a pattern not found.
+    '''
+    first = dict([(pattern, None) for pattern in patterns])
+    for path, found in search_logs(paths, patterns, jobs, index_file,
+                                   newer_than):
+        for pattern, (offset, line) in found.items():
+            if first[pattern] is None:
+                first[pattern] = (path, offset, line)
+        if None not in first.values():
+            break
+    return first
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog -p <pattern> [-p <pattern>] "
+                          "[-j <jobs>] [-a] <path> ...",
+                          description="Search log files for patterns")
+    parser.add_option("-p", "--pattern", action="append", dest="patterns",
+                      help="Regular expression to search, may be repeated")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=4,
+                      help="Number of files searched in parallel")
+    parser.add_option("-a", "--all", action="store_true", dest="all",
+                      help="Report the matches of every file, not only the \
+                  first match of each pattern")
+    (options, args) = parser.parse_args()
+
+    if not options.patterns or not args:
+        parser.print_usage()
+        sys.exit(1)
+
+    if options.all:
+        for path, found in search_logs(args, options.patterns, options.jobs):
+            for pattern, (offset, line) in found.items():
+                print "%s:%d: %s" % (path, offset, line)
+        return
+
+    missing = False
+    for pattern, match in find_first(args, options.patterns,
+                                     options.jobs).items():
+        if match:
+            print "%s:%d: %s" % match
+        else:
+            print "%s: not found" % (pattern)
+            missing = True
+    if missing:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
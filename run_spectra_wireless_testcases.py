@@ -1,14 +1,13 @@
 #!/router/bin/python
 import datetime, subprocess, os, sys
+import log_search
 
-def grep(path, regex):
-    import re
-    regObj = re.compile(regex)
-    for root, dirs, fnames in os.walk(path):
-        for fname in fnames:
-            for line in open(root+fname, 'r'):
-                if regObj.search(line):
-                    return True
+def grep(path, regex, index_file=None):
+    # Search the logs in parallel, with the index_file the logs unchanged
+    # since the last search are not read again.
+    match = log_search.find_first([path], [regex], jobs=8,
+                                  index_file=index_file)[regex]
+    return match is not None
 
 
 if __name__ == "__main__":
@@ -27,7 +26,10 @@ if __name__ == "__main__":
         build_env["PATH"] = build_env["PATH"] + ":/auto/binos-tools/bin/"
         build_env["BINOS_ROOT"] = BINOS_ROOT
         
-        if not grep(BINOS_ROOT+"/BUILD_LOGS/", 'SUCCESS.*build_x86_64_binos_root'):
+        # The index is kept in the workspace, the paths of the logs are
+        # those of the workspace of the day.
+        if not grep(BINOS_ROOT+"/BUILD_LOGS/", 'SUCCESS.*build_x86_64_binos_root',
+                    WS_DIR + "/.log-search-index"):
             os.chdir("ios/sys")
             retcode = subprocess.call("mcp_ios_precommit build_x86_64_binos_root",
                                       env=build_env,
@@ -0,0 +1,91 @@
+#!/usr/bin/env /router/bin/python-2.7.4
+'''
+State files shared by the regression scripts. The JSON state files are
+saved through a temporary file renamed in place, so the concurrent
+readers never see a partial file. The state files several runs update
+at the same time are updated under a lock, see update_json_file(). The
+md5 of the files is cached with the size and mtime of the file, an
+unchanged file is not read again.
+'''
+import os
+import json
+import fcntl
+import hashlib
+
+def load_json_file(filename):
+    '''
+    Load the data saved with save_json_file(). Returns None if the file
+    does not exist or can not be read.
+    '''
+    try:
+        f = open(filename)
+        data = json.load(f)
+        f.close()
+    except (IOError, ValueError):
+        return None
+    return data
+
+
+def save_json_file(filename, data):
+    '''
+    Save the data in the file. The data is written in a temporary file
+    which is renamed so that the concurrent readers never see a partial
+    file. Returns False if the file can not be saved.
+    '''
+    tmp_file = '%s.%d' % (filename, os.getpid())
+    try:
+        f = open(tmp_file, 'w')
+        json.dump(data, f)
+        f.close()
+        os.rename(tmp_file, filename)
+    except (IOError, OSError):
+        print 'WARNING: unable to save %s' % (filename)
+        return False
+    return True
+
+
+def update_json_file(filename, update):
+    '''
+    Load, update and save the data of the file holding an exclusive lock
+    on <filename>.lock, so the runs updating the file at the same time do
+    not drop the updates of one another. update(data) changes the data in
+    place, the data is {} if the file does not exist. Returns what update
+    returns.
+    '''
+    try:
+        lock = open(filename + '.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    except IOError:
+        print 'WARNING: unable to lock %s' % (filename)
+        lock = None
+    try:
+        data = load_json_file(filename) or {}
+        result = update(data)
+        save_json_file(filename, data)
+    finally:
+        if lock:
+            lock.close()
+    return result
+
+
+def file_digest(path, digest_cache=None, key=None):
+    '''
+    Get the md5 of the file content. The digest_cache is used and updated
+    if provided, the digest is kept under the key with the size and the
+    mtime of the file, the key is the path if not provided.
+    '''
+    st = os.stat(path)
+    if key is None:
+        key = path
+    if digest_cache is not None:
+        cached = digest_cache.get(key)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+            return cached[2]
+    md5 = hashlib.md5()
+    f = open(path, 'rb')
+    for block in iter(lambda: f.read(1024 * 1024), ''):
+        md5.update(block)
+    f.close()
+    if digest_cache is not None:
+        digest_cache[key] = [st.st_size, st.st_mtime, md5.hexdigest()]
+    return md5.hexdigest()
@@ -10,10 +10,12 @@ the regression file for each asic family. This wrapper will also execute
 the same test case on all asic families in single invocation.
 
 Usage:
-run_test.py -a <asic> -d <dvpp_release> -t <test> -r <run_opts> -l <log_file> 
+run_test.py -a <asic> -d <dvpp_release> -t <test> -r <run_opts> -l <log_file> [-j <jobs>]
 Output:
     Default log file if (-l) option is not used:
     spectra/logs/log.<asic>.<test>.log
+    With --compress-logs the log is gzip compressed in <log_file>.gz with
+    the index of it in <log_file>.gz.idx.
 
 July 2014, Manas Pati
 
@@ -24,12 +26,26 @@ import os
 import sys
 import platform
 import re
+import json
+import hashlib
+import zlib
+import gzip
 import shutil
 from optparse import OptionParser
 import subprocess
+import multiprocessing
 import xmlrpclib
 from SimpleXMLRPCServer import SimpleXMLRPCServer
+from SocketServer import ThreadingMixIn
+import threading
 import time
+from xml.sax.saxutils import escape, quoteattr
+import socket
+import signal
+import select
+from collections import Counter
+from state_files import load_json_file, save_json_file, update_json_file, \
+    file_digest
 
 supported_asics = ["CS", "D", "G", "GStub", "E", "DL"]
 
@@ -89,6 +105,152 @@ non_dp_tests = {
     "spectraUT" : (True, "/usr/binos/lib", "spectra.py", "-a ", True, "spectra_ut.log"),
 }
 
+#############################################################
+# The sanity checks of the DVPP releases and linkfarms list
+# each directory once and cache the directories found good
+# keyed by the path and mtime, in memory and in the
+# sanity_cache_file of the workspace shared by the
+# invocations. A new or removed entry changes the mtime of
+# the directory.
+#############################################################
+sanity_cache_file = None
+sanity_cache = None
+
+def get_sanity_cache_file(binos_root):
+    return '%s/logs/.sanity-cache' % (get_spectra_root(binos_root))
+
+
+def save_sanity_cache():
+    '''
+    Save the sanity cache in the sanity_cache_file, the directories which
+    do not exist anymore are dropped.
+    '''
+    if sanity_cache is None or not sanity_cache_file:
+        return
+    for directory in sanity_cache.keys():
+        if not os.path.isdir(directory):
+            del sanity_cache[directory]
+    save_json_file(sanity_cache_file, sanity_cache)
+
+
+def check_artifacts(directory, names):
+    '''
+    Check the names are present in the directory. A symlink whose target
+    does not exist is missing. Returns the list of names missing or None
+    if the directory does not exist.
+    '''
+    global sanity_cache
+    try:
+        mtime = os.stat(directory).st_mtime
+    except OSError:
+        return None
+
+    if sanity_cache is None:
+        sanity_cache = {}
+        if sanity_cache_file:
+            sanity_cache = load_json_file(sanity_cache_file) or {}
+    cached = sanity_cache.get(directory)
+    if cached and len(cached) == 3 and cached[0] == mtime and \
+            set(names) <= set(cached[1]):
+        # The target of a link can go away without changing the directory.
+        return [name for name in names if name in cached[2] and
+                not os.path.exists(os.path.join(directory, name))]
+
+    try:
+        entries = set(os.listdir(directory))
+    except OSError:
+        return None
+    missing = []
+    links = set()
+    for name in names:
+        path = os.path.join(directory, name)
+        if name not in entries:
+            missing.append(name)
+        elif os.path.islink(path):
+            links.add(name)
+            if not os.path.exists(path):
+                missing.append(name)
+    if not missing:
+        if cached and len(cached) == 3 and cached[0] == mtime:
+            names = set(names) | set(cached[1])
+            links |= set(cached[2])
+        sanity_cache[directory] = [mtime, sorted(set(names)), sorted(links)]
+    return missing
+
+
+#############################################################
+# EIO cosim runs the tests against the Cima running on a UCS.
+# The Cima is reset after each test through the XML-RPC
+# server on the UCS. The tests run one at a time against a
+# single Cima, the session is kept in cima_session.
+#############################################################
+cima_ready_timeout = 120
+cima_reset_wait = 10
+cima_session = None
+
+class CimaSession(object):
+    '''
+    Session with one Cima instance. The reset of the Cima is started
+    right after the test exits and the session only waits for the Cima
+    to be ready before the next test is started, so the reset overlaps
+    with the processing of the previous test results.
+    '''
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.url = "http://" + ip + ":" + port + "/"
+        self.proxy = xmlrpclib.ServerProxy(self.url, allow_none=True)
+        self.reset_time = None
+
+    def reset(self):
+        '''
+        Request the reset of the Cima without waiting for it.
+        '''
+        self.proxy.resetCima()
+        self.reset_time = time.time()
+
+    def is_ready(self):
+        '''
+        Probe the Cima. Returns True, False or None when the XML-RPC
+        server does not support the probe.
+        '''
+        try:
+            return bool(self.proxy.isCimaReady())
+        except xmlrpclib.Fault:
+            return None
+        except (socket.error, xmlrpclib.ProtocolError):
+            return False
+
+    def wait_ready(self):
+        '''
+        Wait for the Cima to be ready after the last reset, polling the
+        probe with backoff. If the server can not be probed wait for the
+        fixed reset time instead.
+        '''
+        if self.reset_time is None:
+            return True
+        delay = 0.25
+        while time.time() - self.reset_time < cima_ready_timeout:
+            ready = self.is_ready()
+            if ready is None:
+                remaining = cima_reset_wait - (time.time() - self.reset_time)
+                if remaining > 0:
+                    time.sleep(remaining)
+                break
+            if ready:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 4)
+        else:
+            print "ERROR: Cima %s not ready after reset" % (self.url)
+            return False
+        self.reset_time = None
+        return True
+
+    def kill(self):
+        self.proxy.killCima()
+
+
 def get_dvpp_dir(asic, dvpp_rel):
     '''
     Get the DVPP release directory for the dvpp release.
@@ -152,21 +314,20 @@ def sanity_check_dvpp_release(asic, dvpp_rel):
     provided dvpp_release. If required information not found then the
     test can not run.
     '''
-    if not os.path.exists(get_dvpp_dir(asic, dvpp_rel)):
+    missing = check_artifacts(get_dvpp_dir(asic, dvpp_rel),
+                              ['so64_%s' % (dvpp_lib)
+                               for dvpp_lib in dvpp_rel_libs] +
+                              [get_dvpp_exec_name(asic)])
+    if missing is None:
         print 'ERROR: DVPP release %s does not exist' % (dvpp_rel)
         return False
 
-    for dvpp_lib in dvpp_rel_libs:
-        if not os.path.exists('%s/so64_%s' %
-                              (get_dvpp_dir(asic, dvpp_rel), dvpp_lib)):
-            print 'ERROR: DVPP library %s missing' % (dvpp_lib)
-            return False
-    
-    if not os.path.exists(get_dvpp_exec_path(asic, dvpp_rel)):
-        print 'ERROR: DVPP executable missing'
-        return False
-
-    return True
+    for name in missing:
+        if name == get_dvpp_exec_name(asic):
+            print 'ERROR: DVPP executable missing'
+        else:
+            print 'ERROR: DVPP library %s missing' % (name[5:])
+    return not missing
 
 
 def sanity_check_build(binos_root, asic, port_mode):
@@ -175,39 +336,110 @@ def sanity_check_build(binos_root, asic, port_mode):
     '''
     libs_check = spectra_libs
     if port_mode:
-        libs_check += spectra_libs_new
-
-    for spectra_lib in libs_check:
-        if not os.path.exists('%s/usr/binos/lib/lib%s.so' %
-                              (get_linkfarm_asic(binos_root, asic), spectra_lib)):
-            print 'ERROR: spectra library is missing (%s)' % (spectra_lib)
-            return False
+        libs_check = spectra_libs + spectra_libs_new
+
+    missing = check_artifacts('%s/usr/binos/lib' %
+                              (get_linkfarm_asic(binos_root, asic)),
+                              ['lib%s.so' % (spectra_lib)
+                               for spectra_lib in libs_check])
+    if missing is None:
+        print 'ERROR: spectra libraries are missing (%s)' % \
+            (get_linkfarm_asic(binos_root, asic))
+        return False
 
-    return True
+    for name in missing:
+        print 'ERROR: spectra library is missing (%s)' % (name[3:-3])
+    return not missing
 
 
 def link_dvpp_exec(binos_root, asic, dvpp_rel):
     '''
     Link the DVPP executable with the spectra asic linkfarm.
-    If the link already exists then remove it before linking
-    to the new one.
+    A link to the same executable is left alone, otherwise the new link
+    is made under a temporary name and renamed over the old one. The
+    workers sharing the BINOS_ROOT setup the asic at the same time and
+    the tests already running keep a valid link.
     '''
     if not os.path.exists('%s/usr/binos/bin' % (get_linkfarm_asic(binos_root, asic))):
         os.chdir('%s/usr/binos' % (get_linkfarm_asic(binos_root, asic)))
         os.system("mkdir -p bin")
 
     os.chdir('%s/usr/binos/bin' % (get_linkfarm_asic(binos_root, asic)))
-    if os.path.exists(get_dvpp_exec_name(asic)):
-        os.remove(get_dvpp_exec_name(asic))
-    os.symlink(get_dvpp_exec_path(asic, dvpp_rel),
-               get_dvpp_exec_name(asic))
+    dvpp_exec_path = get_dvpp_exec_path(asic, dvpp_rel)
+    dvpp_exec_name = get_dvpp_exec_name(asic)
+    if os.path.islink(dvpp_exec_name) and \
+       os.readlink(dvpp_exec_name) == dvpp_exec_path:
+        return
+    tmp_name = '.%s.%d' % (dvpp_exec_name, os.getpid())
+    if os.path.lexists(tmp_name):
+        os.remove(tmp_name)
+    os.symlink(dvpp_exec_path, tmp_name)
+    os.rename(tmp_name, dvpp_exec_name)
+
+
+def get_lib_dir(binos_root, asic):
+    return '%s/.spectra%s-libs' % (get_spectra_root(binos_root), asic)
+
+
+def lib_dir_is_valid(lib_dir, ld_paths):
+    '''
+    The library directory is valid as long as it was built from the same
+    library paths and no library was added or removed in them since.
+    '''
+    stamp = load_json_file('%s/.ld-paths' % (lib_dir))
+    if not stamp or stamp['ld_paths'] != ld_paths:
+        return False
+    for path, mtime in zip(ld_paths, stamp['mtimes']):
+        if (os.path.getmtime(path) if os.path.isdir(path) else None) != mtime:
+            return False
+    return True
+
+
+def build_lib_dir(lib_dir, ld_paths):
+    '''
+    Link every shared library of the library paths in the library
+    directory, the first one found in the order of the paths like the
+    dynamic loader does. With the directory first in LD_LIBRARY_PATH the
+    loader finds each library with one lookup instead of trying every
+    path, which is most of the startup of the test on NFS. Returns False
+    if the directory can not be built.
+    '''
+    if lib_dir_is_valid(lib_dir, ld_paths):
+        return True
+    tmp_dir = '%s.%d' % (lib_dir, os.getpid())
+    try:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        mtimes = []
+        for path in ld_paths:
+            if not os.path.isdir(path):
+                mtimes.append(None)
+                continue
+            mtimes.append(os.path.getmtime(path))
+            for name in os.listdir(path):
+                if not (name.endswith('.so') or '.so.' in name):
+                    continue
+                if not os.path.lexists('%s/%s' % (tmp_dir, name)):
+                    os.symlink('%s/%s' % (path, name),
+                               '%s/%s' % (tmp_dir, name))
+        save_json_file('%s/.ld-paths' % (tmp_dir),
+                       {'ld_paths': ld_paths, 'mtimes': mtimes})
+        if os.path.exists(lib_dir):
+            shutil.rmtree(lib_dir)
+        os.rename(tmp_dir, lib_dir)
+    except (IOError, OSError), e:
+        print "WARNING: unable to build %s: %s" % (lib_dir, e)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+    return True
 
 
-def set_ld_path(binos_root, asic, dvpp_rel, quiet):
+def get_ld_paths(binos_root, asic, dvpp_rel):
     '''
-    Get the LD_LIBRARY_PATH for the asic linkfarm and the DVPP release.
-    LD_LIBRARY_PATH contains the default linkfarms for all the binos
-    execs. We also need to add all librarry paths used in spectra.
+    Get the library paths for the asic linkfarm and the DVPP release.
+    They contain the default linkfarms for all the binos execs and all
+    the library paths used in spectra.
     '''
     ld_paths = ['%s/linkfarm/x86_64/usr/lib' % (binos_root),
                 '%s/linkfarm/x86_64/usr/binos/lib' % (binos_root),
@@ -220,16 +452,33 @@ def set_ld_path(binos_root, asic, dvpp_rel, quiet):
     for dvpp_lib in dvpp_rel_libs:
         ld_paths.append('%s/so64_%s' %
                 (get_dvpp_dir(asic, dvpp_rel), dvpp_lib))
+    return ld_paths
+
+
+def set_ld_path(binos_root, asic, dvpp_rel, quiet, environ=None,
+                lib_dir=None):
+    '''
+    Get the LD_LIBRARY_PATH for the asic linkfarm and the DVPP release,
+    see get_ld_paths(). The environ is updated, os.environ if it is not
+    provided. When the lib_dir is provided the libraries of all the paths
+    are linked in it and it is put first in LD_LIBRARY_PATH, see
+    build_lib_dir().
+    '''
+    if environ is None:
+        environ = os.environ
+    ld_paths = get_ld_paths(binos_root, asic, dvpp_rel)
+    if lib_dir and build_lib_dir(lib_dir, ld_paths):
+        ld_paths.insert(0, lib_dir)
 
     ld_lib_path = ':'.join(ld_paths)
-    os.environ['LD_LIBRARY_PATH'] = ld_lib_path
+    environ['LD_LIBRARY_PATH'] = ld_lib_path
     # Note, the INSTALL_DIR_PATH is not required anymore but there are some
     # old dvpp release where it checks the INSTALL_DIR_PATH hence make sure
     # it is set otherwise there will be assert in DVPP executable. We will
     # remove it soon.
-    os.environ['INSTALL_DIR_PATH'] = '%s/platforms/ngwc/doppler_sdk/spectra' % (binos_root) 
+    environ['INSTALL_DIR_PATH'] = '%s/platforms/ngwc/doppler_sdk/spectra' % (binos_root) 
     if not quiet:
-        print 'LD_LIBRARY_PATH: %s' % (os.environ['LD_LIBRARY_PATH'])
+        print 'LD_LIBRARY_PATH: %s' % (environ['LD_LIBRARY_PATH'])
 
 
 def get_dvpp_exec_from_linkfarm(binos_root, asic):
@@ -239,44 +488,88 @@ def get_dvpp_exec_from_linkfarm(binos_root, asic):
     return '%s/linkfarm/x86_64-spectra%s/%s' % \
         (binos_root, asic, get_dvpp_exec_name(asic))
 
-def get_test_cases_from_list(test_case_list):
-    test_cases = []
+regress_suite_re = re.compile(r'^\s*([A-Za-z0-9_]+) +=')
+
+def parse_regress_line(line):
+    '''
+    Parse one test entry of the regression file. Returns the tuple
+    (test, run_opts, commit) or None if the line is not a test entry.
+    The run_opts is None when the entry does not carry any run_opts.
+    '''
+    if "," not in line and ";" not in line:
+        return None
+    commit = "COMMIT" in line
+    if commit:
+        line = line.split('+')[0] + ','
+    if "TESTNAME" in line:
+        line = line.split('"')[1]
+    line = line.replace(';', ',')
+    if "_list" in line:
+        return None
+    elif "#" in line or 'AAL_' in line or 'FEATURE_' in line:
+        return None
+    elif "TESTNAME" in line:
+        words = line.split(None, 1)
+        run_opts = words[1].strip() if len(words) > 1 else ''
+        return (words[0].replace('TESTNAME=', ''), run_opts, commit)
+    elif "_" not in line:
+        return (line[:line.find(',')].strip(), None, commit)
+    else:
+        run_opts_temp = line.split('"')
+        run_opts = run_opts_temp[1] if len(run_opts_temp) > 1 else None
+        return (line.split("_")[0].strip(), run_opts, commit)
+
+
+def parse_regress_file(regress_file, cache_file=None):
+    '''
+    Parse the regression file in a single pass and get the list of
+    test records (test, run_opts, suite, commit). A test suite starts
+    with the "<suite> = " line and ends with an empty line, entries
+    outside of a suite have the suite as None. The parsed records are
+    saved in the cache_file keyed by the md5 of the regression file
+    and reused as long as the file content does not change.
+    '''
+    f = open(regress_file, 'r')
+    content = f.read()
+    f.close()
+    digest = hashlib.md5(content).hexdigest()
+
+    if cache_file:
+        cache = load_json_file(cache_file)
+        if cache and cache.get('md5') == digest:
+            return [tuple(record) for record in cache['records']]
+
+    records = []
+    suite = None
+    for line in content.split('\n'):
+        if suite is not None and len(line) == 0:
+            suite = None
+            continue
+        match = regress_suite_re.match(line)
+        if match:
+            suite = match.group(1)
+            continue
+        record = parse_regress_line(line)
+        if record:
+            test, run_opts, commit = record
+            records.append((test, run_opts, suite, commit))
+
+    if cache_file:
+        save_json_file(cache_file, {'md5': digest, 'records': records})
+    return records
 
-    for line in test_case_list:
-        if "," in line or ";" in line:
-            if "COMMIT" in line:
-                line_temp = line.split('+')[0]
-                line = line_temp+','
-            if "TESTNAME" in line:
-                temp_line = line.split('"')[1]
-                line = temp_line
-            if ";" in line:
-                line = line.replace(';', ',')
-            if "_list" in line:
-                pass
-            elif "#" in line or 'AAL_' in line or 'FEATURE_' in line:
-                pass
-            elif "TESTNAME" in line:
-                test_cases += line+'&&&&'
-            elif "_" not in line:
-                position = line.find(',')
-                test_cases += ((line[:position])+'&&&&')
-            elif "_" in line:
-                test_cases += (line.split("_")[0])
-                run_opts_temp = line.split('"')
-                if len(run_opts_temp)>1:
-                    test_cases += ('@'+run_opts_temp[1]+'&&&&')
-
-    test_cases = ''.join(test_cases)
-    test_cases = test_cases[:-4]
-    test_cases = test_cases.split('&&&&')
-    
-    return test_cases
+
+def get_regress_cache_file(binos_root, regress_file):
+    '''
+    Get the file where the parsed regression file is cached.
+    '''
+    return '%s/.spectra-%s' % (get_spectra_root(binos_root),
+                               os.path.basename(regress_file))
 
 def get_regress_file_from_asic(asic, binos_root):
     if asic=='CS':
         regress_file = '%s/scripts/dopplercs_paq.regress' %(get_spectra_root(binos_root))
-    elif asic=='D':
+    elif asic=='D' or asic=='DL':
         regress_file = '%s/scripts/dopplerd_paq.regress' %(get_spectra_root(binos_root))
     elif asic=='E':
         regress_file = '%s/scripts/dopplere_paq.regress' %(get_spectra_root(binos_root))
@@ -285,60 +578,1788 @@ def get_regress_file_from_asic(asic, binos_root):
     
     return regress_file
 
-def locate_testcase (root, testname):
-    for root, dirs, files in os.walk(root):
-        if '.CC' in root: continue
-        if testname+'.py' in files:
-            return True
-    return False
+def get_test_index_file(binos_root):
+    '''
+    Get the file where the test case index is stored for the BINOS_ROOT.
+    '''
+    return '%s/.spectra-test-index' % (get_spectra_root(binos_root))
+
+
+def test_index_is_valid(dirs):
+    '''
+    The index is valid as long as none of the directories it was built
+    from is changed. Adding or removing a file or a sub directory changes
+    the mtime of the directory holding it, so one stat per directory is
+    enough instead of listing the whole tree again.
+    '''
+    for path, signature in dirs.items():
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if [st.st_ino, st.st_mtime] != signature:
+            return False
+    return True
+
+
+def build_test_index(root, index_file=None):
+    '''
+    Build the index of the test cases (test name -> test script) present
+    under the test suite root. The index is saved in the index_file along
+    with the signature of every directory walked and reused by the next
+    invocation when the tree did not change.
+    '''
+    if index_file:
+        index = load_json_file(index_file)
+        if index and index.get('root') == root and \
+                test_index_is_valid(index['dirs']):
+            return index['tests']
+
+    tests = {}
+    dirs = {}
+    for path, subdirs, files in os.walk(root):
+        if '.CC' in path: continue
+        st = os.stat(path)
+        dirs[path] = [st.st_ino, st.st_mtime]
+        for filename in files:
+            if filename.endswith('.py'):
+                tests.setdefault(filename[:-3], os.path.join(path, filename))
+
+    if index_file:
+        save_json_file(index_file, {'root': root, 'dirs': dirs, 'tests': tests})
+    return tests
+
+
+def locate_testcase (test_index, testname):
+    return testname in test_index
                 
 
-def process_log_file (log_file):
-    result = "FAILED"
-    f = open(log_file)
-    for line in f:
-        if "Mismatch in packets sent and received" in line:
-            result = "FAILED - PACKET_MISMATCH"
+def compile_verdicts(verdicts):
+    '''
+    Compile the list of (log text, verdict) into a single regex so that
+    all the verdicts are matched in one pass over the log. The verdict
+    for a match is found from the group which matched.
+    '''
+    regex = re.compile('|'.join(['(%s)' % re.escape(text)
+                                 for text, verdict in verdicts]))
+    max_len = max([len(text) for text, verdict in verdicts])
+    return (regex, [verdict for text, verdict in verdicts], max_len)
+
+dp_verdicts = compile_verdicts([
+    ("Mismatch in packets sent and received", "FAILED - PACKET_MISMATCH"),
+    ("Can't find test", "FAILED - MISSING"),
+    ("Simulation PASSED", "PASSED"),
+])
+
+non_dp_verdicts = compile_verdicts([
+    ("SUMMARY: PASSED", "PASSED"),
+    ("FAILED (failures=", "FAILED"),
+])
+
+def scan_log_tail(log_file, verdicts, block_size=1024*1024):
+    '''
+    Scan the log from the end in blocks and get the verdict of the last
+    verdict line printed in the log. The simulator prints the verdict at
+    the end of the test hence normally only the last block of the log is
+    read. Returns None if no verdict is found in the log.
+    '''
+    regex, results, max_len = verdicts
+    try:
+        f = open(log_file, 'rb')
+    except IOError:
+        return None
+
+    f.seek(0, os.SEEK_END)
+    pos = f.tell()
+    carry = ''
+    verdict = None
+    while pos > 0:
+        start = max(0, pos - block_size)
+        f.seek(start)
+        # Carry the start of the later block so a verdict split across
+        # the block boundary is still matched.
+        data = f.read(pos - start) + carry
+        match = None
+        for match in regex.finditer(data):
+            pass
+        if match:
+            verdict = results[match.lastindex - 1]
             break
-        if "Can't find test" in line:
-            result = "FAILED - MISSING"
+        carry = data[:max_len - 1]
+        pos = start
+    f.close()
+    return verdict
+
+
+def merge_verdict(verdict, new_verdict):
+    '''
+    Get the verdict of the log from the verdict so far and the verdict of
+    the next verdict line. The first failure printed in the log fails the
+    test even if the test prints PASSED after it.
+    '''
+    if verdict is None or verdict == "PASSED":
+        return new_verdict
+    return verdict
+
+
+class LogScanner(object):
+    '''
+    Incremental verdict scanner for the log of a running test. Every
+    scan() only reads what was appended to the log since the previous
+    scan, so the verdict is known as soon as the test prints it and the
+    log is read once while the test writes it.
+    '''
+    def __init__(self, log_file, verdicts=dp_verdicts):
+        self.log_file = log_file
+        self.verdicts = verdicts
+        self.offset = 0
+        self.carry = ''
+        self.verdict = None
+
+    def scan(self, block_size=1024*1024):
+        '''
+        Scan the new part of the log, the verdicts found are merged with
+        merge_verdict(). Returns the verdict so far or None if the test
+        did not print a verdict yet.
+        '''
+        if self.verdict not in (None, "PASSED"):
+            # A failure is final.
+            return self.verdict
+        regex, results, max_len = self.verdicts
+        try:
+            f = open(self.log_file, 'rb')
+        except IOError:
+            return self.verdict
+        f.seek(self.offset)
+        for data in iter(lambda: f.read(block_size), ''):
+            self.offset += len(data)
+            text = self.carry + data
+            for match in regex.finditer(text):
+                # A match within the carry was found by the previous read.
+                if match.end() <= len(self.carry):
+                    continue
+                self.verdict = merge_verdict(self.verdict,
+                                             results[match.lastindex - 1])
+            self.carry = text[-(max_len - 1):]
+        f.close()
+        return self.verdict
+
+
+#############################################################
+# Compressed logs. With --compress-logs the output of the
+# test is piped through the runner, which writes it in
+# <log>.gz and scans it for the verdicts on the way. The gzip
+# file is a series of gzip members of about log_member_size
+# bytes each, zcat reads it like any gzip file. The index
+# <log>.gz.idx keeps the offsets of the members and of the
+# verdict lines so a region of the log is read by
+# decompressing only the members it is in.
+#############################################################
+log_member_size = 1024*1024
+log_max_marks = 100
+
+def get_log_path(log_file):
+    '''
+    Get the file the log is stored in, the compressed log if there is
+    one.
+    '''
+    if os.path.exists(log_file + '.gz'):
+        return log_file + '.gz'
+    return log_file
+
+
+def log_exists(log_file):
+    return os.path.exists(log_file) or os.path.exists(log_file + '.gz')
+
+
+def load_log_index(log_file):
+    return load_json_file(log_file + '.gz.idx')
+
+
+def remove_log(log_file):
+    for path in (log_file, log_file + '.gz', log_file + '.gz.idx'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def link_log(src, dst):
+    '''
+    Hard link the log, plain or compressed with its index, so it takes
+    no extra space. Returns False if there is no log to link.
+    '''
+    remove_log(dst)
+    linked = False
+    for suffix in ('', '.gz', '.gz.idx'):
+        if os.path.exists(src + suffix):
+            os.link(src + suffix, dst + suffix)
+            linked = True
+    return linked
+
+
+def rename_log(src, dst):
+    for suffix in ('', '.gz', '.gz.idx'):
+        if os.path.exists(src + suffix):
+            os.rename(src + suffix, dst + suffix)
+
+
+class CompressedLog(object):
+    '''
+    Writer of the compressed log of a test. The output is scanned for the
+    verdicts as it is written, the offsets (in the uncompressed log) of
+    the verdict lines are kept in the index with the verdict.
+    '''
+    def __init__(self, log_file, verdicts=dp_verdicts):
+        self.log_file = log_file
+        self.verdicts = verdicts
+        self.fp = open(log_file + '.gz', 'wb')
+        self.member = None
+        self.member_start = 0
+        self.size = 0
+        self.members = []
+        self.marks = []
+        self.carry = ''
+        self.verdict = None
+
+    def write(self, data):
+        if self.member is None or \
+           self.size - self.member_start >= log_member_size:
+            if self.member:
+                self.member.close()
+            self.member_start = self.size
+            self.members.append([self.size, self.fp.tell()])
+            self.member = gzip.GzipFile(os.path.basename(self.log_file),
+                                        'wb', 6, self.fp)
+        self.member.write(data)
+
+        regex, results, max_len = self.verdicts
+        text = self.carry + data
+        for match in regex.finditer(text):
+            # A match within the carry was found by the previous write.
+            if match.end() <= len(self.carry):
+                continue
+            verdict = results[match.lastindex - 1]
+            self.verdict = merge_verdict(self.verdict, verdict)
+            if len(self.marks) < log_max_marks:
+                self.marks.append([self.size - len(self.carry) +
+                                   match.start(), verdict])
+        self.carry = text[-(max_len - 1):]
+        self.size += len(data)
+
+    def close(self):
+        if self.member:
+            self.member.close()
+        self.fp.close()
+        save_json_file(self.log_file + '.gz.idx',
+                       {'size': self.size, 'members': self.members,
+                        'marks': self.marks, 'verdict': self.verdict})
+
+
+def read_log(log_file, offset=0, length=-1):
+    '''
+    Read length bytes (all to the end if -1) at the offset of the log,
+    plain or compressed. Only the gzip members from the one the offset is
+    in are decompressed.
+    '''
+    index = load_log_index(log_file)
+    if index is None:
+        f = open(log_file, 'rb')
+        f.seek(offset)
+        data = f.read(length)
+        f.close()
+        return data
+    member_offset, member_pos = 0, 0
+    for member in index['members']:
+        if member[0] > offset:
             break
-        if "Simulation PASSED" in line:
-            result = "PASSED"
+        member_offset, member_pos = member
+    f = open(log_file + '.gz', 'rb')
+    f.seek(member_pos)
+    # GzipFile goes on with the next members after the first one.
+    gz = gzip.GzipFile(fileobj=f)
+    gz.read(offset - member_offset)
+    data = gz.read(length)
+    gz.close()
+    f.close()
+    return data
+
+
+def get_test_cases_in_suite(test_suite, records):
+    '''
+    Get the test records of the test_suite from the parsed regression
+    file records.
+    '''
+    test_cases = [record for record in records if record[2] == test_suite]
+    if test_cases:
+        print "Found test_suite %s" % (test_suite)
+    return test_cases
+
+
+def resolve_test_case(test_case, run_opts):
+    '''
+    Split a test entry into the test name and the run_opts for it. The
+    entry is either plain test name, <test>@<run_opts> or the TESTNAME=
+    form from the regression file. If the entry does not carry run_opts
+    the run_opts passed in is used.
+    '''
+    if '@' in test_case:
+        test_case_temp = test_case.split('@')[0]
+        run_opts = test_case.split('@')[1]
+        test_case = test_case_temp
+    if "TESTNAME" in test_case:
+        temp_test_case = test_case.split()[0].replace('TESTNAME=', '')
+        run_opts = test_case.replace(test_case.split()[0]+' ', '')
+        test_case = temp_test_case
+    return (test_case, run_opts)
+
+
+def get_log_file(binos_root, asic, test_case, run_opts, log_file_opt):
+    '''
+    Get the log file for the test.
+    '''
+    if not log_file_opt:
+        return '%s/logs/%s.%s.%s.log' % (get_spectra_root(binos_root),
+                                         test_case, asic,
+                                         "FEATURE" if "FEATURE" in run_opts
+                                         else "")
+    return '%s/logs/%s' % (get_spectra_root(binos_root), log_file_opt)
+
+
+#############################################################
+# The test index and the environment of the tests of every
+# asic are the same for all the tests of the run. They are
+# set once in each process running tests instead of being
+# sent with every test to the workers.
+#############################################################
+run_test_index = None
+run_test_environs = None
+
+def set_test_env(test_index, test_environs):
+    '''
+    Set the test index and the environment of the tests of each asic
+    ({asic: environ}) used by run_test_job().
+    '''
+    global run_test_index, run_test_environs
+    run_test_index = test_index
+    run_test_environs = test_environs
+
+
+def init_worker(work_dir, test_index, test_environs):
+    '''
+    Initialize the worker process of the parallel test pool. Each worker
+    runs from its own working directory so the files the simulator drops
+    in the current directory do not clash between the workers. The test
+    index and environments are set, see set_test_env().
+    '''
+    set_test_env(test_index, test_environs)
+    worker_dir = '%s/worker.%d' % (work_dir, os.getpid())
+    if not os.path.exists(worker_dir):
+        os.makedirs(worker_dir)
+    os.chdir(worker_dir)
+
+
+#############################################################
+# Result cache, enabled with --result-cache <dir>. A test
+# which passed is not run again as long as the DVPP release,
+# the libraries of LD_LIBRARY_PATH, the DVPP executable, the
+# scripts of the test suite and the run_opts are the same.
+# The cache key is the md5 of all of them and the cache keeps
+# a hard link to the log of the test run. The entries older
+# than result_cache_max_age are pruned, so a test is run
+# again at least that often. The md5 of the big files is
+# kept in the digest file of the cache directory keyed by
+# path, size and mtime. Hashing every library costs a lot on
+# NFS, the cache pays off for a directory shared by the runs
+# of a long lived workspace, not for a fresh workspace.
+#############################################################
+result_cache_max_age = 7 * 24 * 3600
+result_cache_dir = None
+
+def get_file_digest_file(cache_dir):
+    return '%s/.file-digests' % (cache_dir)
+
+
+def save_digest_cache(cache_dir, digest_cache):
+    '''
+    Save the digests in the digest file of the cache directory, the
+    digests of the files which do not exist anymore are dropped.
+    '''
+    for path in digest_cache.keys():
+        if not os.path.exists(path):
+            del digest_cache[path]
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass
+    save_json_file(get_file_digest_file(cache_dir), digest_cache)
+
+
+def get_build_digest(binos_root, asic, dvpp_rel, test_index, digest_cache):
+    '''
+    Get the digest of the DVPP release, of the shared libraries of every
+    path of LD_LIBRARY_PATH (the spectra libraries of the asic linkfarm,
+    the binos libraries and the DVPP libraries), of the DVPP executable
+    used by the tests and of every script of the test suite. The tests
+    import the helper modules of the test suite, a change in any of them
+    can change the result of a test.
+    '''
+    md5 = hashlib.md5()
+    md5.update('dvpp_rel %s\n' % (get_dvpp_dir(asic, dvpp_rel)))
+    for idx, lib_dir in enumerate(get_ld_paths(binos_root, asic, dvpp_rel)):
+        if not os.path.isdir(lib_dir):
+            continue
+        for name in sorted(os.listdir(lib_dir)):
+            path = os.path.join(lib_dir, name)
+            if (name.endswith('.so') or '.so.' in name) and \
+                    os.path.isfile(path):
+                md5.update('%d %s %s\n' % (idx, name,
+                                           file_digest(path, digest_cache)))
+    md5.update('dvpp %s\n' % (file_digest(get_dvpp_exec_path(asic, dvpp_rel),
+                                          digest_cache)))
+    for test_case, test_script in sorted(test_index.items()):
+        md5.update('script %s %s\n' % (test_case,
+                                       file_digest(test_script, digest_cache)))
+    return md5.hexdigest()
+
+
+def get_result_cache_key(build_digest, asic, test_case, run_opts):
+    return hashlib.md5('%s\n%s\n%s\n%s' % (build_digest, asic, test_case,
+                                           run_opts)).hexdigest()
+
+
+def load_cached_result(cache_dir, key, log_file):
+    '''
+    Check the test passed earlier with the same cache key. If so the log
+    of that run is linked as the log file.
+    '''
+    cached_log = '%s/%s.log' % (cache_dir, key)
+    if not log_exists(cached_log):
+        return False
+    try:
+        return link_log(cached_log, log_file)
+    except (IOError, OSError):
+        return False
+
+
+def store_cached_result(cache_dir, key, log_file):
+    '''
+    Keep a hard link to the log of the passed test in the cache.
+    '''
+    if not log_exists(log_file):
+        return
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        cached_log = '%s/%s.log' % (cache_dir, key)
+        tmp_log = '%s.%d' % (cached_log, os.getpid())
+        link_log(log_file, tmp_log)
+        remove_log(cached_log)
+        rename_log(tmp_log, cached_log)
+    except (IOError, OSError):
+        print 'WARNING: unable to cache the result of %s' % (log_file)
+
+
+def prune_result_cache(cache_dir, max_age=result_cache_max_age):
+    '''
+    Remove the cached results older than max_age seconds.
+    '''
+    if not os.path.isdir(cache_dir):
+        return
+    now = time.time()
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def read_output(pipe, log, wait):
+    '''
+    Wait for the output of the test on the pipe and write it in the log,
+    all the output ready is read so the test does not block on a full
+    pipe. Returns False once the test closed the pipe.
+    '''
+    for count in range(64):
+        ready, _, _ = select.select([pipe], [], [], wait if not count else 0)
+        if not ready:
             break
+        data = os.read(pipe, 65536)
+        if not data:
+            return False
+        log.write(data)
+    return True
+
+
+def kill_process_group(pid, sig):
+    '''
+    Send the signal to the test and every process it started, the test
+    is started in its own process group.
+    '''
+    try:
+        os.killpg(pid, sig)
+    except OSError:
+        pass
+
+
+def run_command(cmd, log_file, limits, verdicts=None, env=None,
+                compress=False):
+    '''
+    Run the test command with the output appended to the log file and
+    watch it until it exits. With compress the output is piped through
+    the runner in the compressed log instead, see CompressedLog. With the
+    verdicts the log is scanned for them as it is written, see
+    LogScanner. The limits is the tuple (timeout, stall_timeout, grace)
+    in seconds, 0 disables the check:
+      timeout: wall clock budget of the test.
+      stall_timeout: the log did not grow for this long.
+      grace: time the test may keep running after the verdict is
+             printed in the log (needs the verdicts to scan the log).
+    The env is the environment of the test, None to inherit it.
+    Returns the tuple (exit code, timed_out, rusage, libs, verdict), the
+    exit code is negative when the test is killed by a signal, libs is the
+    set of spectra libraries sampled from the test process and verdict is
+    the verdict of the log, None if none is found or without verdicts.
+    '''
+    timeout, stall_timeout, grace = limits
+    scanner = None
+    pipe = None
+    if compress:
+        log = CompressedLog(log_file, verdicts or dp_verdicts)
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                preexec_fn=os.setsid, env=env)
+        pipe = proc.stdout.fileno()
+    else:
+        log = open(log_file, 'a')
+        proc = subprocess.Popen(cmd, shell=True, stdout=log,
+                                stderr=subprocess.STDOUT,
+                                preexec_fn=os.setsid, env=env)
+        log.close()
+        if verdicts:
+            scanner = LogScanner(log_file, verdicts)
+    start = time.time()
+    last_growth = start
+    last_size = 0
+    verdict_time = 0
+    kill_time = 0
+    timed_out = False
+    libs = set()
+    libs_time = 0
+    libs_interval = 0.2
+    while True:
+        # wait4 reaps the test with the resource usage of it and of all
+        # the processes it waited for.
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            break
+        if pipe is None:
+            time.sleep(0.2)
+        elif not read_output(pipe, log, 0.2):
+            pipe = None
+        now = time.time()
+        if kill_time:
+            # Asked the test to terminate, kill it if it does not.
+            if now - kill_time > 5:
+                kill_process_group(proc.pid, signal.SIGKILL)
+            continue
+
+        if compress:
+            size = log.size
+        else:
+            try:
+                size = os.path.getsize(log_file)
+            except OSError:
+                size = 0
+        if size != last_size:
+            last_size = size
+            last_growth = now
+        if compress:
+            verdict = log.verdict
+        else:
+            verdict = scanner.scan() if scanner else None
+        if grace and verdict and not verdict_time:
+            verdict_time = now
+        # The libraries are loaded at start up, sample often at first.
+        if now - libs_time >= libs_interval:
+            libs |= get_mapped_libs(proc.pid)
+            libs_time = now
+            libs_interval = min(libs_interval * 2, 10)
+
+        if timeout and now - start > timeout:
+            print "Test exceeded %d seconds, killing it" % (timeout)
+            timed_out = True
+        elif stall_timeout and now - last_growth > stall_timeout:
+            print "No log output for %d seconds, killing the test" % \
+                (stall_timeout)
+            timed_out = True
+        elif verdict_time and now - verdict_time > grace:
+            print "Test did not exit after the verdict, killing it"
+        else:
+            continue
+        kill_process_group(proc.pid, signal.SIGTERM)
+        kill_time = now
+
+    if kill_time:
+        kill_process_group(proc.pid, signal.SIGKILL)
+    if compress:
+        # Get the rest of the output, the processes the test left behind
+        # may hold the pipe open so do not wait for them.
+        drain_start = time.time()
+        while pipe is not None and time.time() - drain_start < 5:
+            if not read_output(pipe, log, 0.2):
+                pipe = None
+        proc.stdout.close()
+        log.close()
+        verdict = log.verdict
+    else:
+        # Get the verdicts of the rest of the log.
+        verdict = scanner.scan() if scanner else None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return (proc.returncode, timed_out, rusage, libs, verdict)
+
+
+def test_record(asic, test_case, run_opts, result, log_file, start,
+                exit_code=None, rusage=None, libs=None):
+    '''
+    Get the record of the test result written in the results file. The
+    resource usage of the test comes from the rusage of wait4, it covers
+    the test and all the processes it waited for: CPU time in seconds,
+    max_rss in KB and the bytes read from and written to the storage
+    (the rusage blocks are the /proc io read_bytes/write_bytes in 512
+    byte units). The libs are the spectra libraries used by the test.
+    '''
+    record = {
+        'test': test_case,
+        'asic': asic,
+        'run_opts': run_opts,
+        'result': result,
+        'duration': round(time.time() - start, 3),
+        'log': get_log_path(log_file),
+        'exit_code': exit_code,
+        'user_cpu': None,
+        'sys_cpu': None,
+        'max_rss': None,
+        'read_bytes': None,
+        'write_bytes': None,
+        'libs': sorted(libs) if libs else [],
+        'cached': False,
+    }
+    if rusage:
+        record['user_cpu'] = round(rusage.ru_utime, 3)
+        record['sys_cpu'] = round(rusage.ru_stime, 3)
+        record['max_rss'] = rusage.ru_maxrss
+        record['read_bytes'] = rusage.ru_inblock * 512
+        record['write_bytes'] = rusage.ru_oublock * 512
+    return record
+
+
+def run_test_job(test_job):
+    '''
+    Execute one test and get the result of it. The test_job is a tuple
+    of the environment (binos_root, asic, eio_cosim, limits, build_digest,
+    compress_logs) and the job (idx, count,
+    test_case, run_opts, log_file). Returns the test record, see
+    test_record().
+    '''
+    env, job = test_job
+    (binos_root, asic, eio_cosim_flag, limits, build_digest,
+     compress_logs) = env
+    test_index = run_test_index
+    test_environ = run_test_environs[asic]
+    idx, count, test_case, run_opts, log_file = job
+    test_passed = False
+    result = "FAILED"
+    start = time.time()
+
+    out_file = log_file
+    remove_log(log_file)
+
+    if not locate_testcase(test_index, test_case):
+        print "Test %s doesn't exist" % test_case
+        return test_record(asic, test_case, run_opts, "FAILED - MISSING",
+                           log_file, start)
+
+    cache_key = None
+    if build_digest:
+        cache_key = get_result_cache_key(build_digest, asic, test_case,
+                                         run_opts)
+        if load_cached_result(result_cache_dir, cache_key, log_file):
+            print "Test %s passed earlier with the same build (cached)" % \
+                (test_case)
+            record = test_record(asic, test_case, run_opts, "PASSED",
+                                 log_file, start)
+            record['cached'] = True
+            return record
+
+    print "Running Test %s (%d/%d)" % (test_case, idx, count)
+    if test_case in non_dp_tests:
+        ndp_python, ndp_loc, ndp_test, ndp_opts, ndp_asic, ndp_log = non_dp_tests[test_case]
+        if ndp_python:
+            if ndp_asic:
+                exec_cmd = '%s/usr/bin/python2.7 %s/%s/%s %s Doppler%s' % \
+                        (get_linkfarm(binos_root), \
+                        get_linkfarm_asic(binos_root, asic), \
+                        ndp_loc, ndp_test, ndp_opts, asic)
+            else:
+                exec_cmd = '%s/usr/bin/python2.7 %s/%s/%s %s' % \
+                        (get_linkfarm(binos_root), \
+                        get_linkfarm_asic(binos_root, asic), \
+                        ndp_loc, ndp_test, ndp_opts)
+        else: 
+            if ndp_asic:
+                exec_cmd = '%s%s/%s %s Doppler%s' % \
+                        (get_linkfarm_asic(binos_root, asic), \
+                        ndp_loc, ndp_test, ndp_opts, asic)
+            else:
+                exec_cmd = '%s%s/%s %s' % \
+                        (get_linkfarm_asic(binos_root, asic), \
+                        ndp_loc, ndp_test, ndp_opts)
+
+        if ndp_log:
+            out_file = ndp_log
+            if os.path.exists(ndp_log):
+                os.remove(ndp_log)
+
+        exit_code, timed_out, rusage, libs, verdict = \
+            run_command(exec_cmd, out_file, limits, env=test_environ)
+        if ndp_log:
+            test_passed = scan_log_tail("%s/logs/%s" % \
+                                        (get_spectra_root(binos_root), ndp_log),
+                                        non_dp_verdicts) == "PASSED"
+        else:
+            test_passed = scan_log_tail(log_file, non_dp_verdicts) == "PASSED"
+
+    else:
+        if eio_cosim_flag:
+            exec_cmd = "python paq_main.py"
+            cima_session.wait_ready()
+        else:
+            exec_cmd = '%s/usr/binos/bin/%s' % \
+                    (get_linkfarm_asic(binos_root, asic), get_dvpp_exec_name(asic))
+        exit_code, timed_out, rusage, libs, verdict = \
+            run_command("%s TESTNAME=%s %s" % (exec_cmd, test_case, run_opts),
+                        out_file, limits, dp_verdicts, test_environ,
+                        compress_logs)
+        if eio_cosim_flag:
+            # Reset the Cima for the next test while the results are
+            # processed.
+            cima_session.reset()
+        result = verdict or "FAILED"
+        test_passed = True if result == "PASSED" else False
+       
+    if timed_out:
+        test_passed = False
+        result = "FAILED - TIMEOUT"
+
+    if test_passed:
+        print "- PASSED"
+        result = "PASSED"
+        if cache_key:
+            store_cached_result(result_cache_dir, cache_key, log_file)
+    else:
+        print "- FAILED"
+    return test_record(asic, test_case, run_opts, result, log_file, start,
+                       exit_code, rusage, libs)
+
+def run_indexed_test_job(indexed_job):
+    '''
+    Execute the test job at the position in the run. Returns the tuple
+    (position, test record) so the results completed out of order by the
+    workers are put back in the order of the run.
+    '''
+    pos, test_job = indexed_job
+    return (pos, run_test_job(test_job))
+
+
+def execute_test_jobs(pool, indexed_jobs, results_fp, retry=False):
+    '''
+    Execute the (position, test_job) list on the pool of workers or in
+    this process if there is no pool. Yields (position, test record) as
+    the tests complete, the records are streamed in the results file.
+    The tests passing on a retry are reported as "PASSED (flaky)".
+    '''
+    if pool:
+        completed = pool.imap_unordered(run_indexed_test_job, indexed_jobs)
+    else:
+        completed = (run_indexed_test_job(indexed_job)
+                     for indexed_job in indexed_jobs)
+    for pos, record in completed:
+        if retry and record['result'] == "PASSED":
+            record = dict(record, result="PASSED (flaky)")
+        write_result(results_fp, record)
+        yield (pos, record)
+
+
+def write_result(results_fp, record):
+    '''
+    Stream the test record as one JSON line in the results file. The line
+    is flushed right away so the file can be read while the run is going.
+    The record of a failed test has the signature of the failure, see
+    get_failure_signature().
+    '''
+    if results_fp:
+        if not record['result'].startswith("PASSED"):
+            record['signature'] = get_failure_signature(record)[0]
+        results_fp.write(json.dumps(record, sort_keys=True) + '\n')
+        results_fp.flush()
+
+
+def write_junit_results(junit_file, asics, asic_results):
+    '''
+    Write the results in JUnit XML format, one test suite per asic.
+    '''
+    f = open(junit_file, 'w')
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    f.write('<testsuites>\n')
+    for asic in asics:
+        records = asic_results[asic]
+        failures = len([record for record in records
+                        if not record['result'].startswith("PASSED")])
+        f.write('  <testsuite name=%s tests="%d" failures="%d" time="%.3f">\n' %
+                (quoteattr("Doppler%s" % asic), len(records), failures,
+                 sum([record['duration'] for record in records])))
+        for record in records:
+            f.write('    <testcase classname=%s name=%s time="%.3f">' %
+                    (quoteattr("Doppler%s" % asic), quoteattr(record['test']),
+                     record['duration']))
+            if not record['result'].startswith("PASSED"):
+                f.write('<failure message=%s>%s</failure>' %
+                        (quoteattr(record['result']),
+                         escape("log: %s" % (record['log']))))
+            f.write('</testcase>\n')
+        f.write('  </testsuite>\n')
+    f.write('</testsuites>\n')
     f.close()
-    return result
- 
-def get_test_cases_in_suite(test_suite, regress_file):
+
+
+#############################################################
+# The duration of the tests run is kept in the history file
+# keyed by asic, test and run_opts. The parallel runs start
+# the longest tests first (LPT) so the long tests do not end
+# up last and dominate the end of the run.
+#############################################################
+test_history_file = os.path.expanduser('~/.spectra-test-history')
+
+def test_history_key(asic, test_case, run_opts):
+    return '%s|%s|%s' % (asic, test_case, run_opts)
+
+
+def update_test_history(history, records):
     '''
-    Parse the regression file and get the test_suites present in it.
-    Then get the test cases and associated runOpts for the test case.
+    Update the test durations in the history with the tests executed in
+    the run, the duration is smoothed over the runs.
     '''
-    if not os.path.exists(regress_file):
-        return test_cases;
+    for record in records:
+        if record['exit_code'] is None:
+            continue
+        key = test_history_key(record['asic'], record['test'],
+                               record['run_opts'])
+        if key in history:
+            history[key] = round((history[key] + record['duration']) / 2, 3)
+        else:
+            history[key] = record['duration']
+
+
+def schedule_test_jobs(indexed_jobs, history):
+    '''
+    Order the (position, test_job) list longest estimated duration first.
+    The workers pick the next job as they get free, which makes it the
+    LPT schedule. A test never run before is estimated with the median
+    duration of the tests known for the asic.
+    '''
+    durations = {}
+    for key, duration in history.items():
+        durations.setdefault(key.split('|', 1)[0], []).append(duration)
+    for asic in durations:
+        durations[asic] = sorted(durations[asic])[len(durations[asic]) / 2]
+
+    def estimate(indexed_job):
+        pos, (env, job) = indexed_job
+        asic = env[1]
+        return history.get(test_history_key(asic, job[2], job[3]),
+                           durations.get(asic, 0))
 
-    inputfile = open(regress_file, 'r')
-    test_suite_found = False
-    test_list = []
+    return sorted(indexed_jobs, key=estimate, reverse=True)
 
-    for line in inputfile:
-        if not test_suite_found:
-            if test_suite in line and  '=' in line and line.split(test_suite,1)[1][0] == ' ':
-                test_suite_found = True
-                print "Found test_suite %s" % line.split('=',1)[0]
+
+#############################################################
+# Test impact selection. The spectra libraries mapped by the
+# test process are sampled while the test runs and kept in
+# the impact file keyed by asic, test and run_opts. When the
+# changed files or libraries are provided only the tests
+# using the changed libraries, the tests never sampled and
+# the sanity tests are run.
+#############################################################
+test_impact_file = os.path.expanduser('~/.spectra-test-impact')
+impact_sanity_tests = ["L2Basic", "L3Basic"]
+
+def get_group_pids(pgid):
+    '''
+    Get the processes of the process group.
+    '''
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            f = open('/proc/%s/stat' % (entry))
+            stat = f.read()
+            f.close()
+        except IOError:
+            continue
+        # The command name in the stat can have spaces, the fields
+        # after it are state, ppid and pgrp.
+        if int(stat.rsplit(')', 1)[1].split()[2]) == pgid:
+            pids.append(int(entry))
+    return pids
+
+
+def get_mapped_libs(pgid):
+    '''
+    Get the spectra libraries mapped by the processes of the test process
+    group. The maps show the path the linkfarm links resolve to, the
+    libraries are found from the name of the file.
+    '''
+    lib_names = set(['lib%s.so' % (lib)
+                     for lib in spectra_libs + spectra_libs_new])
+    libs = set()
+    for pid in get_group_pids(pgid):
+        try:
+            f = open('/proc/%d/maps' % (pid))
+            for line in f:
+                name = os.path.basename(line.rstrip())
+                if name in lib_names:
+                    libs.add(name)
+            f.close()
+        except IOError:
+            pass
+    return libs
+
+
+def get_changed_libs(changed):
+    '''
+    Get the spectra libraries for the list of changed files or libraries.
+    An entry is a library (libafd.so or afd) or a file in the directory
+    of a library. Returns None if an entry does not belong to a library,
+    then all the tests are impacted.
+    '''
+    lib_names = set(spectra_libs + spectra_libs_new)
+    libs = set()
+    for entry in changed:
+        entry = entry.strip()
+        if not entry:
+            continue
+        name = os.path.basename(entry)
+        if name.startswith('lib') and name.endswith('.so'):
+            libs.add(name)
+        elif name in lib_names:
+            libs.add('lib%s.so' % (name))
         else:
-            line = line.replace('\n', '')
-            if len(line) > 0:
-                test_list.append(line)
+            components = [c for c in entry.split('/') if c in lib_names]
+            if not components:
+                return None
+            libs.add('lib%s.so' % (components[-1]))
+    return libs
+
+
+def select_impacted_jobs(test_jobs, changed_libs, impact):
+    '''
+    Select the test jobs impacted by the changed libraries.
+    '''
+    selected = []
+    for env, job in test_jobs:
+        libs = impact.get(test_history_key(env[1], job[2], job[3]))
+        if libs is None or job[2] in impact_sanity_tests or \
+                changed_libs.intersection(libs):
+            selected.append((env, job))
+    return selected
+
+
+def update_test_impact(impact, records):
+    '''
+    Add the libraries used by the tests which passed in the run to the
+    libraries known for them. The libraries are sampled, a run misses the
+    ones loaded between two samples, and a test failing or timing out may
+    not get to load all of them, so the runs are only added up.
+    '''
+    for record in records:
+        if not record['libs'] or not record['result'].startswith("PASSED"):
+            continue
+        key = test_history_key(record['asic'], record['test'],
+                               record['run_opts'])
+        impact[key] = sorted(set(impact.get(key, [])) | set(record['libs']))
+
+
+#############################################################
+# Failed tests are executed again up to --retries times,
+# within the --retry-budget of reruns for the whole run. A
+# test failing first and passing on a retry is reported as
+# "PASSED (flaky)". The number of passes and failures of the
+# tests are kept in the flaky file, a test with both is
+# flaky and gets retried first.
+#############################################################
+test_flaky_file = os.path.expanduser('~/.spectra-test-flaky')
+
+def update_test_flakiness(flaky, records):
+    '''
+    Count the passes and failures of the tests executed.
+    '''
+    for record in records:
+        if record['exit_code'] is None:
+            continue
+        key = test_history_key(record['asic'], record['test'],
+                               record['run_opts'])
+        counts = flaky.setdefault(key, [0, 0])
+        counts[0 if record['result'].startswith("PASSED") else 1] += 1
+
+
+def get_retry_job(test_job):
+    '''
+    Get the test job for the retry of a failed test, the retry runs
+    without the result cache so a pass on a retry is never cached.
+    '''
+    env, job = test_job
+    return (env[:4] + (None,) + env[5:], job)
+
+
+def is_flaky(flaky, record):
+    counts = flaky.get(test_history_key(record['asic'], record['test'],
+                                        record['run_opts']), [0, 0])
+    return counts[0] > 0 and counts[1] > 0
+
+
+def get_retry_positions(results, flaky, budget):
+    '''
+    Get the positions of the failed tests to execute again, the tests
+    known to be flaky first. A missing test is not retried.
+    '''
+    failed = [pos for pos, record in enumerate(results)
+              if not record['result'].startswith("PASSED") and
+              record['result'] != "FAILED - MISSING"]
+    failed.sort(key=lambda pos: not is_flaky(flaky, results[pos]))
+    return sorted(failed[:budget])
+
+
+#############################################################
+# Failure signatures. The error lines at the end of the log
+# of a failed test are normalized, without the addresses,
+# numbers and timestamps which change from run to run, and
+# hashed in the signature of the failure. The failed tests
+# are grouped by signature so a regression breaking many
+# tests shows as one cluster. The signatures seen are kept
+# in the signature file with the first and last run they
+# were seen in.
+#############################################################
+failure_signature_file = os.path.expanduser('~/.spectra-failure-signatures')
+failure_tail_size = 64*1024
+failure_max_lines = 5
+failure_line_re = re.compile(r'[Mm]ismatch|[Aa]ssert|[Ee]rror|ERROR|FAIL|'
+                             r'[Ff]ault|[Ee]xception|[Tt]imeout|core dumped')
+failure_normalize_res = [
+    (re.compile(r'\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(\.\d+)?'), '<time>'),
+    (re.compile(r'\d\d:\d\d:\d\d(\.\d+)?'), '<time>'),
+    (re.compile(r'([0-9a-fA-F]{2}[:.-]){5}[0-9a-fA-F]{2}'), '<mac>'),
+    (re.compile(r'\d+\.\d+\.\d+\.\d+'), '<ip>'),
+    (re.compile(r'0x[0-9a-fA-F]+'), '<hex>'),
+    (re.compile(r'/[^\s:]*/'), '<path>/'),
+    (re.compile(r'\d+'), '<n>'),
+]
+
+def read_log_tail(log_file, size):
+    '''
+    Read the lines in the last size bytes of the log, plain or
+    compressed.
+    '''
+    index = load_log_index(log_file)
+    if index is not None:
+        start = max(0, index['size'] - size)
+        data = read_log(log_file, start)
+    else:
+        f = open(log_file, 'rb')
+        f.seek(0, os.SEEK_END)
+        start = max(0, f.tell() - size)
+        f.seek(start)
+        data = f.read()
+        f.close()
+    lines = data.splitlines()
+    # The first line is cut unless the whole log is read.
+    return lines[1:] if start else lines
+
+
+def normalize_failure_line(line):
+    for regex, text in failure_normalize_res:
+        line = regex.sub(text, line)
+    return ' '.join(line.split())
+
+
+def get_failure_signature(record):
+    '''
+    Get the (signature, text) of the failure of the test record. The text
+    is the result and the first error lines of the end of the log,
+    normalized, or the last lines if there is no error line.
+    '''
+    lines = []
+    log_file = record['log']
+    if log_file.endswith('.gz'):
+        log_file = log_file[:-len('.gz')]
+    tail = []
+    # The result of a test timing out does not depend on the log, the
+    # log is cut wherever the test was killed.
+    if record['result'] != "FAILED - TIMEOUT":
+        try:
+            tail = read_log_tail(log_file, failure_tail_size)
+        except (IOError, OSError):
+            pass
+    tail_lines = [normalize_failure_line(line)
+                  for line in tail if line.strip()]
+    for line in tail_lines:
+        if failure_line_re.search(line) and line not in lines:
+            lines.append(line)
+            if len(lines) == failure_max_lines:
+                break
+    if not lines:
+        lines = tail_lines[-failure_max_lines:]
+    text = '\n'.join([record['result']] + lines)
+    return (hashlib.md5(text).hexdigest()[:12], text)
+
+
+def cluster_failures(records):
+    '''
+    Group the records which did not pass by the signature of the failure.
+    Returns the list of (signature, text, records), the biggest first.
+    '''
+    clusters = {}
+    for record in records:
+        if record['result'].startswith("PASSED"):
+            continue
+        signature, text = get_failure_signature(record)
+        clusters.setdefault(signature, (signature, text, []))[2].append(record)
+    return sorted(clusters.values(), key=lambda cluster: -len(cluster[2]))
+
+
+def update_failure_signatures(signatures, clusters):
+    '''
+    Record the clusters of the run in the signature history. Returns the
+    signatures seen for the first time.
+    '''
+    now = time.strftime('%Y-%m-%d %H:%M')
+    new = set()
+    for signature, text, records in clusters:
+        if signature not in signatures:
+            signatures[signature] = {'text': text, 'first_seen': now,
+                                     'runs': 0, 'tests': []}
+            new.add(signature)
+        entry = signatures[signature]
+        entry['last_seen'] = now
+        entry['runs'] += 1
+        for record in records:
+            key = test_history_key(record['asic'], record['test'],
+                                   record['run_opts'])
+            if key not in entry['tests'] and len(entry['tests']) < 50:
+                entry['tests'].append(key)
+    return new
+
+
+def print_failure_clusters(clusters, signatures, new):
+    print "Failure clusters:"
+    for signature, text, records in clusters:
+        entry = signatures[signature]
+        print "  %s  %d tests  %s" % (signature, len(records),
+                                      "new" if signature in new else
+                                      "seen in %d runs since %s" %
+                                      (entry['runs'], entry['first_seen']))
+        for line in text.splitlines():
+            print "      %s" % (line)
+        print "      %s" % (', '.join(["Doppler%s %s" % (record['asic'],
+                                                        record['test'])
+                                       for record in records]))
+    print
+
+
+#############################################################
+# Distributed run. With --serve the test runner is the
+# coordinator of the run: it parses the tests and hands them
+# out over XML-RPC to the test runners started with --worker
+# on the sim hosts. The tests are kept in one work queue in
+# the scheduled order, every worker slot takes the next test
+# of the queue when it is free. The workers run the tests
+# from their own BINOS_ROOT and send back the log in chunks
+# and then the test record. The server handles every request
+# in its own thread so a log upload does not hold up the
+# other workers.
+#############################################################
+worker_connect_timeout = 60
+worker_poll_interval = 1
+log_chunk_size = 4 * 1024 * 1024
+
+class CoordinatorServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class TestCoordinator(object):
+    '''
+    XML-RPC coordinator of the tests run by the worker hosts. It has the
+    imap_unordered(), close(), terminate() and join() of the
+    multiprocessing pool so the run and the retries of main() execute the
+    test jobs on the workers the same way as on a local pool.
+    '''
+    def __init__(self, port, run_info, limits):
+        self.run_info = json.dumps(run_info)
+        self.limits = limits
+        self.server = CoordinatorServer(('', port), allow_none=True,
+                                        logRequests=False)
+        self.server.timeout = worker_poll_interval
+        self.server.register_instance(self)
+        self.lock = threading.Lock()
+        self.hosts = []
+        self.queue = []
+        self.jobs = {}
+        self.in_flight = {}
+        self.attempts = {}
+        self.completed = []
+        print "Coordinator listening on %s:%d" % \
+            (socket.gethostname(), self.server.server_address[1])
+
+    def _dispatch(self, method, params):
+        if method not in ('register', 'get_job', 'put_log', 'put_result'):
+            raise xmlrpclib.Fault(1, 'method "%s" is not supported' % method)
+        if method == 'put_log':
+            # The log chunks are written without the lock, the chunks of
+            # the workers go to different files.
+            return self.put_log(*params)
+        self.lock.acquire()
+        try:
+            return getattr(self, method)(*params)
+        finally:
+            self.lock.release()
+
+    def register(self, host):
+        '''
+        Register the worker host, returns the description of the run.
+        '''
+        if host not in self.hosts:
+            print "Worker %s joined the run" % (host)
+            self.hosts.append(host)
+        return self.run_info
+
+    def get_job(self, host):
+        '''
+        Get the next test of the worker host as the list [position,
+        attempt, asic, idx, count, test_case, run_opts, log_file,
+        use_cache]. An empty list means there is no test for now and the
+        worker asks again later. The log file of a test given out again is numbered so the
+        log of the earlier attempt is kept.
+        '''
+        self.register(host)
+        if self.queue:
+            pos = self.queue.pop(0)
+        else:
+            pos = self.get_lost_job()
+            if pos is None:
+                return []
+        self.in_flight[pos] = (host, time.time())
+        self.attempts[pos] = self.attempts.get(pos, 0) + 1
+        test_job = self.jobs[pos]
+        env, (idx, count, test_case, run_opts, log_file) = test_job
+        if self.attempts[pos] > 1:
+            log_file = '%s.%d' % (log_file, self.attempts[pos])
+        return [pos, self.attempts[pos], env[1], idx, count, test_case,
+                run_opts, log_file, env[4] is not None]
+
+    def get_lost_job(self):
+        '''
+        Get a test whose worker should have completed it by now, the host
+        is taken to be lost and the test is given to another worker. Tests
+        can only be lost when they have a timeout.
+        '''
+        timeout, stall_timeout, grace = self.limits
+        if not timeout:
+            return None
+        for pos, (host, start) in sorted(self.in_flight.items()):
+            if time.time() - start > timeout + grace + 60:
+                print "Test %s of worker %s is lost, running it again" % \
+                    (self.jobs[pos][1][2], host)
+                return pos
+        return None
+
+    def is_running(self, pos, attempt):
+        '''
+        Check that the attempt of the test is the one the coordinator waits
+        for, the earlier attempts of a test given out again are dropped.
+        '''
+        return pos in self.in_flight and self.attempts[pos] == attempt
+
+    def get_upload_file(self, pos, attempt, suffix):
+        '''
+        Get the file the log of the attempt is uploaded in, it is renamed
+        to the log file of the test once the test is completed.
+        '''
+        return '%s%s.upload.%d' % (self.jobs[pos][1][4], suffix, attempt)
+
+    def put_log(self, host, pos, attempt, suffix, offset, data):
+        '''
+        Write the chunk of the log of the test at the offset. The suffix
+        is '.gz' for a compressed log, the chunks of a plain log are zlib
+        compressed. Returns False if the test is not run by the worker
+        anymore.
+        '''
+        if not self.is_running(pos, attempt):
+            return False
+        data = data.data
+        if not suffix:
+            data = zlib.decompress(data)
+        f = open(self.get_upload_file(pos, attempt, suffix),
+                 'r+b' if offset else 'wb')
+        f.seek(offset)
+        f.write(data)
+        f.close()
+        return True
+
+    def put_result(self, host, pos, attempt, record, suffix=None,
+                   log_index=None):
+        '''
+        Complete the test at the position with the JSON test record of the
+        worker. The log uploaded with put_log() becomes the log file of the
+        test, the suffix is None if the worker has no log and the JSON
+        index comes with a compressed log.
+        '''
+        if not self.is_running(pos, attempt):
+            # The test was given to another worker and completed by it.
+            return False
+        del self.in_flight[pos]
+        record = json.loads(record)
+        log_file = self.jobs[pos][1][4]
+        remove_log(log_file)
+        # The partial uploads of the lost attempts.
+        for lost in range(1, attempt):
+            for lost_suffix in ('', '.gz'):
+                upload_file = self.get_upload_file(pos, lost, lost_suffix)
+                if os.path.exists(upload_file):
+                    os.remove(upload_file)
+        if suffix is not None:
+            upload_file = self.get_upload_file(pos, attempt, suffix)
+            if os.path.exists(upload_file):
+                os.rename(upload_file, log_file + suffix)
             else:
+                # An empty log has no chunk.
+                open(log_file + suffix, 'wb').close()
+            if log_index is not None:
+                save_json_file(log_file + suffix + '.idx',
+                               json.loads(log_index))
+            record['log'] = get_log_path(log_file)
+        else:
+            print "WARNING: worker %s has no log for %s" % (host,
+                                                           record['test'])
+        record['host'] = host
+        self.completed.append((pos, record))
+        return True
+
+    def imap_unordered(self, func, indexed_jobs):
+        '''
+        Queue the (position, test_job) list in the order of the list and
+        serve the workers until all the tests are completed. Yields
+        (position, test record) as the tests complete. The tests are run
+        by run_test_job() on the workers.
+        '''
+        self.lock.acquire()
+        for pos, test_job in indexed_jobs:
+            self.jobs[pos] = test_job
+            self.queue.append(pos)
+        self.lock.release()
+        remaining = len(indexed_jobs)
+        while remaining:
+            self.server.handle_request()
+            self.lock.acquire()
+            completed = self.completed
+            self.completed = []
+            self.lock.release()
+            for result in completed:
+                remaining -= 1
+                yield result
+
+    def close(self):
+        self.server.server_close()
+
+    def terminate(self):
+        self.server.server_close()
+
+    def join(self):
+        pass
+
+
+def get_worker_log_file(binos_root, host, log_file):
+    '''
+    Get the local log file of the worker for the log file of the
+    coordinator. The logs of the workers are kept apart so the worker
+    hosts sharing the BINOS_ROOT with the coordinator do not clash.
+    '''
+    log_dir = '%s/logs/workers/%s' % (get_spectra_root(binos_root), host)
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    return '%s/%s' % (log_dir, os.path.basename(log_file))
+
+
+def send_result(coordinator, host, pos, attempt, record, log_file):
+    '''
+    Send the log of the test to the coordinator in chunks of
+    log_chunk_size and then the test record. A compressed log is sent as
+    is with its index, a plain log is zlib compressed.
+    '''
+    log_index = load_log_index(log_file)
+    if log_index is not None:
+        suffix = '.gz'
+    elif os.path.exists(log_file):
+        suffix = ''
+    else:
+        coordinator.put_result(host, pos, attempt, json.dumps(record))
+        return
+    f = open(log_file + suffix, 'rb')
+    offset = 0
+    for data in iter(lambda: f.read(log_chunk_size), ''):
+        if not suffix:
+            data = zlib.compress(data)
+        if not coordinator.put_log(host, pos, attempt, suffix, offset,
+                                   xmlrpclib.Binary(data)):
+            # The test was given to another worker.
+            f.close()
+            return
+        offset = f.tell()
+    f.close()
+    if log_index is not None:
+        log_index = json.dumps(log_index)
+    coordinator.put_result(host, pos, attempt, json.dumps(record), suffix,
+                           log_index)
+
+
+def run_worker_slot(coordinator_url, host, asic_envs, work_dir, test_index,
+                    test_environs):
+    '''
+    Run the tests of the coordinator one at a time until the coordinator
+    closes the run. A worker host runs one slot per job.
+    '''
+    init_worker(work_dir, test_index, test_environs)
+    binos_root = asic_envs.values()[0][0]
+    coordinator = xmlrpclib.ServerProxy(coordinator_url, allow_none=True)
+    while True:
+        try:
+            job = coordinator.get_job(host)
+        except (socket.error, xmlrpclib.ProtocolError):
+            return
+        if not job:
+            time.sleep(worker_poll_interval)
+            continue
+        (pos, attempt, asic, idx, count, test_case, run_opts, log_file,
+         use_cache) = job
+        log_file = get_worker_log_file(binos_root, host, log_file)
+        test_job = (asic_envs[asic],
+                    (idx, count, test_case, run_opts, log_file))
+        if not use_cache:
+            test_job = get_retry_job(test_job)
+        record = run_test_job(test_job)
+        try:
+            send_result(coordinator, host, pos, attempt, record, log_file)
+        except (socket.error, xmlrpclib.ProtocolError):
+            return
+
+
+def run_worker(coordinator, binos_root, jobs, quiet_mode):
+    '''
+    Run the tests given by the coordinator at host:port on this host
+    with the given number of jobs. Every asic of the run is setup with
+    the DVPP release of the coordinator. Returns False if the run can not
+    be joined.
+    '''
+    global result_cache_dir
+
+    coordinator_url = "http://%s/" % (coordinator)
+    host = '%s.%d' % (socket.gethostname(), os.getpid())
+    proxy = xmlrpclib.ServerProxy(coordinator_url, allow_none=True)
+    start = time.time()
+    while True:
+        try:
+            run_info = json.loads(proxy.register(host))
+            break
+        except (socket.error, xmlrpclib.ProtocolError):
+            if time.time() - start > worker_connect_timeout:
+                print "ERROR: coordinator %s not reachable" % (coordinator)
+                return False
+            time.sleep(worker_poll_interval)
+    print "Worker %s joined the run of %s" % (host, coordinator)
+
+    test_index = build_test_index(get_spectra_root(binos_root) +
+                                  "/scripts/test_suite",
+                                  get_test_index_file(binos_root))
+    limits = tuple(run_info['limits'])
+    asic_envs = {}
+    test_environs = {}
+    result_cache_dir = run_info['result_cache']
+    digest_cache = {}
+    if result_cache_dir:
+        digest_cache = load_json_file(
+            get_file_digest_file(result_cache_dir)) or {}
+    for asic, dvpp_rel in zip(run_info['asics'], run_info['dvpp_rels']):
+        dvpp_rel = setup_asic(binos_root, asic, dvpp_rel, False,
+                              run_info['port_mode'], quiet_mode)
+        if dvpp_rel is None:
+            return False
+        test_environ = dict(os.environ)
+        lib_dir = None
+        if run_info['lib_dir']:
+            lib_dir = get_lib_dir(binos_root, asic)
+        set_ld_path(binos_root, asic, dvpp_rel, quiet_mode, test_environ,
+                    lib_dir)
+        build_digest = None
+        if result_cache_dir:
+            try:
+                build_digest = get_build_digest(binos_root, asic, dvpp_rel,
+                                                test_index, digest_cache)
+            except (IOError, OSError):
+                print "WARNING: unable to get the build digest, not caching"
+        asic_envs[asic] = (binos_root, asic, False, limits, build_digest,
+                           run_info['compress_logs'])
+        test_environs[asic] = test_environ
+    save_sanity_cache()
+    if result_cache_dir:
+        save_digest_cache(result_cache_dir, digest_cache)
+        prune_result_cache(result_cache_dir)
+
+    work_dir = '%s/logs/workers/%s' % (get_spectra_root(binos_root), host)
+    slots = [multiprocessing.Process(target=run_worker_slot,
+                                     args=(coordinator_url, host, asic_envs,
+                                           work_dir, test_index,
+                                           test_environs))
+             for slot in range(jobs)]
+    try:
+        for slot in slots:
+            slot.start()
+        for slot in slots:
+            slot.join()
+    except KeyboardInterrupt:
+        for slot in slots:
+            slot.terminate()
+        return False
+    print "Worker %s done" % (host)
+    return True
+
+
+def setup_asic(binos_root, asic, dvpp_rel, eio_cosim_flag, port_mode,
+               quiet_mode):
+    '''
+    Do the one time setup of the asic before running the tests: check the
+    build and the DVPP release and link the DVPP executable in the asic
+    linkfarm. If the DVPP release is not provided the one used earlier or
+    the stable release is used. Returns the DVPP release or None if the
+    tests can not run for the asic.
+    '''
+    if eio_cosim_flag:
+        return ''
+
+    if sanity_check_build(binos_root, asic, port_mode) == False:
+        return None
+
+    dvpp_file = '%s/.spectra%s-dvpp' % (get_spectra_root(binos_root), asic)
+
+    ##################################################################### 
+    # If the DVPP release is provided in command line option use it.
+    # If not provided if it was provided in earlier test cases. If
+    # not use the standard stable release.
+    ##################################################################### 
+    if not dvpp_rel:
+        if os.path.exists(dvpp_file):
+            for line in open(dvpp_file):
+                dvpp_rel = line
                 break
+        else:
+            try:
+                d_path, dvpp_rel, patch_rel, d_exec = dvpp_rel_info[asic]
+            except KeyError:
+                print "No stable DVPP release found"
+                pass
+
+    if not quiet_mode:
+        print "Using the DVPP release: %s" % (dvpp_rel)
 
-    return get_test_cases_from_list(test_list)
+    if sanity_check_dvpp_release(asic, dvpp_rel) == False:
+        print "DVPP release %s not found" % (dvpp_rel)
+        return None
+
+    if not os.path.exists(dvpp_file):
+        f = open(dvpp_file, 'w')
+        f.write(dvpp_rel)
+        f.close()
+    else:
+        old_dvpp_rel = ""
+        for line in open(dvpp_file):
+            old_dvpp_rel = line
+            break
+        if dvpp_rel != old_dvpp_rel:
+            os.remove(dvpp_file)
+            f = open(dvpp_file, 'w')
+            f.write(dvpp_rel)
+            f.close()
+    link_dvpp_exec(binos_root, asic, dvpp_rel)
+    return dvpp_rel
+
+
+def load_failed_tests(results_file):
+    '''
+    Get the tests which did not pass in the results file written with the
+    --results option. Returns the list of (asic, test, run_opts) in the
+    order of the run, the last record of a test is its result.
+    '''
+    tests = []
+    results = {}
+    for line in open(results_file):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        key = (record['asic'], record['test'], record['run_opts'])
+        if key not in results:
+            tests.append(key)
+        results[key] = record['result']
+    return [key for key in tests if not results[key].startswith("PASSED")]
+
+
+def get_test_cases(options, binos_root, asic, failed_tests=None):
+    '''
+    Get the test records (test, run_opts, suite, commit) to run on the
+    asic from the options, or the failed_tests of the asic when rerunning
+    the failures. Returns the tuple (test_cases, run_opts_loop),
+    run_opts_loop is '@' when the run_opts must not carry over from one
+    test to the next.
+    '''
+    test_cases = []
+    run_opts_loop = ''
+
+    if failed_tests is not None:
+        test_cases = [(test, run_opts, None, False)
+                      for failed_asic, test, run_opts in failed_tests
+                      if failed_asic == asic]
+    elif options.testsuite:
+        test_suites = options.testsuite.split(':')
+        regress_file = get_regress_file_from_asic(asic, binos_root)
+        records = []
+        if os.path.exists(regress_file):
+            records = parse_regress_file(regress_file,
+                        get_regress_cache_file(binos_root, regress_file))
+        for test in test_suites:
+            testcase = get_test_cases_in_suite(test, records)
+            if options.commitregression:
+                testcase = [record for record in testcase if record[3]]
+            print "Appending test from \'" + test + "\' testsuite" 
+            test_cases.extend(testcase)
+            
+    elif options.testcases:
+        test_cases = [resolve_test_case(test_case, None) + (None, False)
+                      for test_case in options.testcases.split(':')]
+    elif options.file_testcases:
+        try:
+            f = open(options.file_testcases, 'r')
+            test_cases = [resolve_test_case(test_case, None) + (None, False)
+                          for test_case in f.read().split(':')]
+        except IOError as e:
+            print 'ERROR: File not found : %s' % options.file_testcases
+            sys.exit(1)
+
+    elif options.regression:
+        regress_file = get_regress_file_from_asic(asic, binos_root)
+        try:
+            test_cases = parse_regress_file(regress_file,
+                            get_regress_cache_file(binos_root, regress_file))
+        except IOError:
+            print 'ERROR: regression file not found for Doppler%s' % (asic)
+            sys.exit(1)
+        run_opts_loop = '@'
+    else:
+        print 'ERROR: test case are not provided'
+        sys.exit(1)
+
+    return (test_cases, run_opts_loop)
+
+
+def print_results(asic, results):
+    '''
+    Print the results table of the asic.
+    '''
+    print
+    border = "+" + "-" * 42 + "+" + "-" * 8 + ("+" + "-" * 10) * 2 + "+"
+    print "Results Doppler%s Test Count: %d" % (asic, len(results))
+    print border
+    for record in results:
+        print "| %-40s | %6s | %8s | %8s |" % \
+            (record['test'], record['result'],
+             "%.1fs" % (record['duration']),
+             "%dMB" % (record['max_rss'] / 1024) if record['max_rss']
+             else "-")
+    print border
+    print
+
+
+def print_top_tests(records, top):
+    '''
+    Print the tests which took the most time and memory, so the tests
+    dominating the run can be found.
+    '''
+    if not top or not records:
+        return
+    print "Slowest tests:"
+    for record in sorted(records, key=lambda r: r['duration'],
+                         reverse=True)[:top]:
+        print "  %9.1fs  cpu %9.1fs  Doppler%s %s %s" % \
+            (record['duration'],
+             (record['user_cpu'] or 0) + (record['sys_cpu'] or 0),
+             record['asic'], record['test'], record['run_opts'])
+    print "Heaviest tests:"
+    for record in sorted(records, key=lambda r: r['max_rss'],
+                         reverse=True)[:top]:
+        print "  %8dMB  io %8dMB  Doppler%s %s %s" % \
+            ((record['max_rss'] or 0) / 1024,
+             ((record['read_bytes'] or 0) + (record['write_bytes'] or 0)) /
+             (1024 * 1024),
+             record['asic'], record['test'], record['run_opts'])
+    print
+
+
+def print_result_matrix(asics, asic_results):
+    '''
+    Print the results of all the asics side by side, one row per test.
+    '''
+    tests = []
+    matrix = {}
+    for asic in asics:
+        for record in asic_results[asic]:
+            test_case = record['test']
+            if test_case not in matrix:
+                tests.append(test_case)
+                matrix[test_case] = {}
+            matrix[test_case].setdefault(asic, []).append(record['result'])
+
+    border = "+" + "-" * 42 + ("+" + "-" * 26) * len(asics) + "+"
+    print "Results Matrix"
+    print border
+    print "| %-40s |" % ("Test") + \
+        "".join([" %-24s |" % ("Doppler%s" % asic) for asic in asics])
+    print border
+    for test_case in tests:
+        print "| %-40s |" % (test_case) + \
+            "".join([" %-24s |" % (", ".join(matrix[test_case].get(asic,
+                                                                   ["-"])))
+                     for asic in asics])
+    print border
+    print
 
 def main():
     '''
     Main parse routines for Test runner.
     '''
+    global cima_session, sanity_cache_file, result_cache_dir
+
     parser = OptionParser(usage="usage: %prog\n"
                           "-d <dvpp_release> \n"
                           "-t <test_names> \n"
@@ -348,13 +2369,18 @@ def main():
                           "-c <commit_regression> \n"
                           "-r <run_opts_for_test> \n"
                           "-b <binos_root> \n"
-                          "-a <asic> \n"
+                          "-a <asics> \n"
                           "-l <logfile>\n"
                           "-p <newportedcode>\n"
                           "-e <EIO_cosim>\n" 
-                          "-i <ip address of UCS running Cima>\n"
-                          "-n <port number Cima sniffs on>\n"
-                          "-q <quiet>\n",
+                          "-i <ip addresses of UCS running Cima>\n"
+                          "-n <port numbers Cima sniffs on>\n"
+                          "-q <quiet>\n"
+                          "-j <jobs>\n"
+                          "--rerun-failed <results_file>\n"
+                          "--serve <port>\n"
+                          "--worker <coordinator_host:port>\n"
+                          "-w <timeout_in_seconds>\n",
                           description="Spectra Test Runner")
 
     parser.add_option("-t", "--test-cases", dest="testcases",
@@ -373,7 +2399,8 @@ def main():
                       help="Run commit regression tests from test suite.\
                   Used with the -s options.")
     parser.add_option("-d", "--dvpp-release", dest="dvpprelease",
-                      help="DVPP release location. Only required for first time \
+                      help="DVPP release location, one per asic with \
+                  separator (:) when multiple asics are used. Only required for first time \
                   or overwriting the existing DVPP information. If not \
                   specified then the latest stable release is picked up\
                   from DVPP release.")
@@ -391,25 +2418,63 @@ def main():
                       dest="port", help="Run tests with ported code")
     parser.add_option("-e", "--eio", action="store_true",
                       dest="eio_cosim", help="Run tests in cosim environment")
-    parser.add_option("-i", "--ip", dest="cima_ip", help="ip of UCS running Cima")
+    parser.add_option("-i", "--ip", dest="cima_ip",
+                      help="ip of UCS running Cima")
     parser.add_option("-n", "--portNumber", dest="port_number", 
                     help="port number that UCS listens on")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="Number of tests to execute in parallel")
+    parser.add_option("--rerun-failed", dest="rerun_failed",
+                      help="Results file of an earlier run, only the tests \
+                  which did not pass in it are run with the same run_opts")
+    parser.add_option("--serve", dest="serve", type="int",
+                      help="Coordinate the run on this port, the tests are \
+                  run by the test runners started with --worker")
+    parser.add_option("--worker", dest="worker",
+                      help="Run the tests of the coordinator at host:port \
+                  with -j jobs on this host")
+    parser.add_option("--results", dest="results",
+                      help="File where the result of each test is written \
+                  as one JSON line as soon as the test completes")
+    parser.add_option("--junit", dest="junit",
+                      help="File where the results are written in JUnit XML")
+    parser.add_option("--impacted", dest="impacted",
+                      help="File with the changed files or libraries, one per \
+                  line. Only the tests using them are run")
+    parser.add_option("--result-cache", dest="result_cache",
+                      help="Directory of the result cache, the tests which \
+                  passed earlier with the same build, DVPP release, test \
+                  scripts and run_opts are not run again")
+    parser.add_option("--no-lib-dir", action="store_true", dest="no_lib_dir",
+                      help="Do not link the libraries of LD_LIBRARY_PATH in \
+                  one directory, the loader searches every path")
+    parser.add_option("--compress-logs", action="store_true",
+                      dest="compress_logs", help="Store the logs of the \
+                  tests gzip compressed in <log>.gz with an index of the \
+                  verdict lines in <log>.gz.idx")
+    parser.add_option("--retries", dest="retries", type="int", default=0,
+                      help="Number of times a failed test is executed again")
+    parser.add_option("--retry-budget", dest="retry_budget", type="int",
+                      default=20, help="Maximum number of test executions \
+                  for the retries of the whole run")
+    parser.add_option("--top", dest="top", type="int", default=5,
+                      help="Number of slowest and heaviest tests reported")
+    parser.add_option("-w", "--timeout", dest="timeout", type="int",
+                      default=0, help="Kill the test after these many seconds")
+    parser.add_option("--stall-timeout", dest="stall_timeout", type="int",
+                      default=0, help="Kill the test if the log does not \
+                  grow for these many seconds")
+    parser.add_option("--grace", dest="grace", type="int", default=0,
+                      help="Seconds a test may keep running after printing \
+                  the verdict, 0 waits for the test to exit")
     (options, args) = parser.parse_args()
 
     binos_root = ''
-    asic = ''
-    dvpp_rel = ''
-    run_opts_loop = ''
-    test_suites = []
-    test_cases = []
-    commit = False
     log_file_opt = ""
     quiet_mode = False
     port_mode = False
     eio_cosim_flag = False 
-    cima_ip_address = ""
-    cima_port_number = ""
-    CimaProxy = None 
+    cima_endpoint = None
 
     if options.logfile:
         log_file_opt = options.logfile
@@ -424,10 +2489,10 @@ def main():
         print "Running in EIO cosim mode"
         eio_cosim_flag = True
         if options.cima_ip and options.port_number:
-            cima_ip_address = options.cima_ip
-            cima_port_number = options.port_number
-            url = "http://" + cima_ip_address + ":" + cima_port_number + "/"
-            CimaProxy = xmlrpclib.ServerProxy(url, allow_none=True) 
+            if ':' in options.cima_ip or ':' in options.port_number:
+                print "ERROR: EIO cosim runs the tests on a single Cima"
+                sys.exit(1)
+            cima_endpoint = (options.cima_ip, options.port_number)
         else:
             print "ERROR: UCS ip and port number not provided"
             sys.exit(1)
@@ -441,255 +2506,276 @@ def main():
         except KeyError:
             print "ERROR: BINOS_ROOT is not set"
             sys.exit(1)
+    sanity_cache_file = get_sanity_cache_file(binos_root)
 
-    if options.asicversion:
-        asic = options.asicversion[7:]
-        if asic not in supported_asics:
-            print "ERROR: asic [%s] not supported" % (options.asicversion)
+    if options.worker:
+        if not run_worker(options.worker, binos_root, options.jobs or 1,
+                          quiet_mode):
             sys.exit(1)
+        return
+
+    failed_tests = None
+    if options.rerun_failed:
+        try:
+            failed_tests = load_failed_tests(options.rerun_failed)
+        except IOError:
+            print 'ERROR: File not found : %s' % options.rerun_failed
+            sys.exit(1)
+        if not failed_tests:
+            print 'No failed test in %s' % options.rerun_failed
+            sys.exit(0)
+
+    if options.asicversion:
+        asics = [asicversion[7:] for asicversion in
+                 options.asicversion.split(':')]
+    elif failed_tests:
+        asics = []
+        for failed_asic, test, run_opts in failed_tests:
+            if failed_asic not in asics:
+                asics.append(failed_asic)
+    else:
+        asics = []
+
+    if asics:
+        for asic in asics:
+            if asic not in supported_asics:
+                print "ERROR: asic [Doppler%s] not supported" % (asic)
+                sys.exit(1)
     else:
         print "ERROR: ASIC version not provided"
         sys.exit(1)
 
-    if eio_cosim_flag == False and sanity_check_build(binos_root, asic, port_mode) == False:
+    if eio_cosim_flag and len(asics) > 1:
+        print "ERROR: EIO cosim runs a single asic"
         sys.exit(1)
 
-    if not quiet_mode:
-        print "Using BINOS_ROOT: %s" % (binos_root)
-
-    exec_log_file = '%s/logs/run_test.log' % (get_spectra_root(binos_root))
-    dvpp_file = '%s/.spectra%s-dvpp' % (get_spectra_root(binos_root), asic)
-    dvpp_exec = '%s/usr/binos/bin/%s' % \
-            (get_linkfarm_asic(binos_root, asic), get_dvpp_exec_name(asic))
-
-    if eio_cosim_flag == False:
-        ##################################################################### 
-        # If the DVPP release is provided in command line option use it.
-        # If not provided if it was provided in earlier test cases. If
-        # not use the standard stable release.
-        ##################################################################### 
-        if options.dvpprelease:
-            dvpp_rel = options.dvpprelease
-        else:
-            if os.path.exists(dvpp_file):
-                for line in open(dvpp_file):
-                    dvpp_rel = line
-                    break
-            else:
-                try:
-                    d_path, dvpp_rel, patch_rel, d_exec = dvpp_rel_info[asic]
-                except KeyError:
-                    print "No stable DVPP release found"
-                    pass
-
-        if not quiet_mode:
-            print "Using the DVPP release: %s" % (dvpp_rel)
+    if eio_cosim_flag and options.serve:
+        print "ERROR: EIO cosim can not be run by workers"
+        sys.exit(1)
 
-        if sanity_check_dvpp_release(asic, dvpp_rel) == False:
-            print "DVPP release %s not found" % (dvpp_rel)
+    dvpp_rels = [''] * len(asics)
+    if options.dvpprelease:
+        dvpp_rels = options.dvpprelease.split(':')
+        if len(dvpp_rels) != len(asics):
+            print "ERROR: provide one DVPP release per asic"
             sys.exit(1)
 
-        if not os.path.exists(dvpp_file):
-            f = open(dvpp_file, 'w')
-            f.write(dvpp_rel)
-            f.close()
-        else:
-            old_dvpp_rel = ""
-            for line in open(dvpp_file):
-                old_dvpp_rel = line
-                break
-            if dvpp_rel != old_dvpp_rel:
-                os.remove(dvpp_file)
-                f = open(dvpp_file, 'w')
-                f.write(dvpp_rel)
-                f.close()
-        link_dvpp_exec(binos_root, asic, dvpp_rel)
-
-    if options.testsuite:
-        test_suites = options.testsuite.split(':')
-        regress_file = get_regress_file_from_asic(asic, binos_root)
-        for test in test_suites:
-            testcase = get_test_cases_in_suite(test,regress_file)
-            print "Appending test from \'" + test + "\' testsuite" 
-            test_cases.extend(testcase)
-            
-    elif options.testcases:
-        test_cases = options.testcases.split(':')
-    elif options.file_testcases:
-        try:
-            f = open(options.file_testcases, 'r')
-            test_cases =f.read().split(':')
-        except IOError as e:
-            print 'ERROR: File not found : %s' % options.file_testcases
-            sys.exit(1)
-
-    elif options.regression:
-        if asic=='CS':
-            regress_file = '%s/scripts/dopplercs_paq.regress' %(get_spectra_root(binos_root))
-        elif asic=='D':
-            regress_file = '%s/scripts/dopplerd_paq.regress' %(get_spectra_root(binos_root))
-        elif asic=='E':
-            regress_file = '%s/scripts/dopplere_paq.regress' %(get_spectra_root(binos_root))
-        elif asic=='DL':
-            regress_file = '%s/scripts/dopplerd_paq.regress' %(get_spectra_root(binos_root))
-        inputfile = open(regress_file, 'r')
-        regress_lines = inputfile.readlines()
-        line_number = 0
-        run_opts_loop = '@'
-        for line in regress_lines:
-            line_number += 1
-            if "," in line or ";" in line:
-                if "COMMIT" in line:
-                    line_temp = line.split('+')[0]
-                    line = line_temp+','
-                if "TESTNAME" in line:
-                    temp_line = line.split('"')[1]
-                    line = temp_line
-                if ";" in line:
-                    line = line.replace(';', ',')
-                if "_list" in line:
-                    pass
-                elif "#" in line or 'AAL_' in line or 'FEATURE_' in line:
-                    pass
-                elif "TESTNAME" in line:
-                    test_cases += line+'&&&&'
-                elif "_" not in line:
-                    position = line.find(',')
-                    test_cases += ((line[:position])+'&&&&')
-                elif "_" in line:
-                    test_cases += (line.split("_")[0])
-                    run_opts_temp = line.split('"')
-                    if len(run_opts_temp)>1:
-                        test_cases += ('@'+run_opts_temp[1]+'&&&&')
-        test_cases = ''.join(test_cases)
-        test_cases = test_cases[:-4]
-        test_cases = test_cases.split('&&&&')
-    else:
-        print 'ERROR: test case are not provided'
-        sys.exit(1)
-
-    if len(test_cases) == 0:
-        print 'No test case provided or found in the test suite'
-        sys.exit(1)
+    if not quiet_mode:
+        print "Using BINOS_ROOT: %s" % (binos_root)
 
     run_opts = ''
     if options.runopts:
         run_opts = options.runopts
 
-    set_ld_path(binos_root, asic, dvpp_rel, quiet_mode)
-    results = []
-    
-    for idx, test_case in enumerate(test_cases):
-        test_passed = False
-        if run_opts_loop=='@':
-            run_opts = ''
-        if '@' in test_case:
-            test_case_temp = test_case.split('@')[0]
-            run_opts = test_case.split('@')[1]
-            test_case = test_case_temp
-        if "TESTNAME" in test_case:
-            temp_test_case = test_case.split()[0].replace('TESTNAME=', '')
-            run_opts = test_case.replace(test_case.split()[0]+' ', '')
-            test_case = temp_test_case
-        if not log_file_opt:
-            log_file = '%s/logs/%s.%s.%s.log' % (get_spectra_root(binos_root), 
-                                              test_case, asic,
-                                              "FEATURE" if "FEATURE" in run_opts
-                                              else "")
-        else:
-            log_file = '%s/logs/%s'%(get_spectra_root(binos_root), log_file_opt)
-        
-        log_redirect = ' >> %s 2>&1' % (log_file)
-        if os.path.exists(log_file):
-            os.remove(log_file)
- 
-        if not locate_testcase(get_spectra_root(binos_root) +
-                               "/scripts/test_suite", test_case): 
-            print "Test %s doesn't exist" % test_case
-            results.append((test_case, "FAILED - MISSING"))
-            continue
-        print "Running Test %s (%d/%d)" % (test_case, idx, len(test_cases))
-        if test_case in non_dp_tests:
-            ndp_python, ndp_loc, ndp_test, ndp_opts, ndp_asic, ndp_log = non_dp_tests[test_case]
-            if ndp_python:
-                if ndp_asic:
-                    exec_cmd = '%s/usr/bin/python2.7 %s/%s/%s %s Doppler%s' % \
-                            (get_linkfarm(binos_root), \
-                            get_linkfarm_asic(binos_root, asic), \
-                            ndp_loc, ndp_test, ndp_opts, asic)
-                else:
-                    exec_cmd = '%s/usr/bin/python2.7 %s/%s/%s %s' % \
-                            (get_linkfarm(binos_root), \
-                            get_linkfarm_asic(binos_root, asic), \
-                            ndp_loc, ndp_test, ndp_opts)
-            else: 
-                if ndp_asic:
-                    exec_cmd = '%s%s/%s %s Doppler%s' % \
-                            (get_linkfarm_asic(binos_root, asic), \
-                            ndp_loc, ndp_test, ndp_opts, asic)
-                else:
-                    exec_cmd = '%s%s/%s %s' % \
-                            (get_linkfarm_asic(binos_root, asic), \
-                            ndp_loc, ndp_test, ndp_opts)
-
-            if ndp_log:
-                log_redirect = ' >> %s 2>&1' % (ndp_log)
-                if os.path.exists(ndp_log):
-                    os.remove(ndp_log)
-
-            os.system("%s %s" % (exec_cmd, log_redirect))
-            check_file = True
-            if ndp_log:
-                try:
-                    f = open("%s/logs/%s" % (get_spectra_root(binos_root), ndp_log))
-                except IOError:
-                    check_file = False
-                    test_passed = False
-            else:
-                try:
-                    f = open(log_file)
-                except IOError:
-                    check_file = False
-                    test_passed = False
-            if check_file:
-                for line in f:
-                    if "SUMMARY: PASSED" in line:
-                        test_passed = True
-                    if "FAILED (failures=" in line:
-                        test_passed = False
-                f.close()
+    jobs = 1
+    if options.jobs:
+        jobs = options.jobs
+        if jobs < 1:
+            print "ERROR: number of jobs must be at least 1"
+            sys.exit(1)
+        if eio_cosim_flag and jobs > 1:
+            # paq_main.py is not known to take the Cima endpoint from
+            # CIMA_IP/CIMA_PORT, parallel jobs could all drive the same
+            # Cima.
+            print "EIO cosim runs the tests serially on Cima %s:%s" % \
+                cima_endpoint
+            jobs = 1
+
+    # The test index is shared by all the asics.
+    test_index = build_test_index(get_spectra_root(binos_root) +
+                                  "/scripts/test_suite",
+                                  get_test_index_file(binos_root))
+    limits = (options.timeout, options.stall_timeout, options.grace)
+
+    # Setup every asic once up front and resolve the run_opts of every
+    # test, the run_opts carries over from one entry to the next unless
+    # it is reset by the regression file.
+    test_jobs = []
+    asic_dvpp_rels = []
+    test_environs = {}
+    result_cache_dir = options.result_cache
+    digest_cache = {}
+    if result_cache_dir:
+        result_cache_dir = os.path.abspath(result_cache_dir)
+        digest_cache = load_json_file(
+            get_file_digest_file(result_cache_dir)) or {}
+    for asic, dvpp_rel in zip(asics, dvpp_rels):
+        dvpp_rel = setup_asic(binos_root, asic, dvpp_rel, eio_cosim_flag,
+                              port_mode, quiet_mode)
+        if dvpp_rel is None:
+            sys.exit(1)
+        asic_dvpp_rels.append(dvpp_rel)
+
+        test_cases, run_opts_loop = get_test_cases(options, binos_root, asic,
+                                                   failed_tests)
+        if len(test_cases) == 0:
+            if failed_tests is not None:
+                print 'No failed test to rerun for Doppler%s' % (asic)
+                continue
+            print 'No test case provided or found in the test suite'
+            sys.exit(1)
 
+        test_environ = dict(os.environ)
+        lib_dir = None
+        if not options.no_lib_dir:
+            lib_dir = get_lib_dir(binos_root, asic)
+        set_ld_path(binos_root, asic, dvpp_rel, quiet_mode, test_environ,
+                    lib_dir)
+
+        # The cosim results depend on the remote Cima, they are not cached.
+        build_digest = None
+        if result_cache_dir and not eio_cosim_flag:
+            try:
+                build_digest = get_build_digest(binos_root, asic, dvpp_rel,
+                                                test_index, digest_cache)
+            except (IOError, OSError):
+                print "WARNING: unable to get the build digest, not caching"
+        env = (binos_root, asic, eio_cosim_flag, limits, build_digest,
+               bool(options.compress_logs))
+        test_environs[asic] = test_environ
+
+        asic_run_opts = run_opts
+        for idx, (test_case, test_opts, suite, commit) in enumerate(test_cases):
+            if run_opts_loop=='@':
+                asic_run_opts = ''
+            if test_opts is not None:
+                asic_run_opts = test_opts
+            log_file = get_log_file(binos_root, asic, test_case, asic_run_opts,
+                                    log_file_opt)
+            test_jobs.append((env, (idx, len(test_cases), test_case,
+                                    asic_run_opts, log_file)))
+
+    set_test_env(test_index, test_environs)
+    save_sanity_cache()
+    if result_cache_dir:
+        save_digest_cache(result_cache_dir, digest_cache)
+        prune_result_cache(result_cache_dir)
+
+    if options.impacted:
+        try:
+            changed_libs = get_changed_libs(open(options.impacted).readlines())
+        except IOError:
+            print 'ERROR: File not found : %s' % options.impacted
+            sys.exit(1)
+        if changed_libs is None:
+            print "Changes outside of the spectra libraries, running all tests"
         else:
-            if eio_cosim_flag:
-                exec_cmd = "python paq_main.py"
-            else:
-                exec_cmd = '%s/usr/binos/bin/%s' % \
-                        (get_linkfarm_asic(binos_root, asic), get_dvpp_exec_name(asic))
-            os.system("%s TESTNAME=%s %s %s" % (exec_cmd, test_case, run_opts, log_redirect))
-            result = process_log_file(log_file)
-            test_passed = True if result == "PASSED" else False
-           
-        if test_passed:
-            print "- PASSED"
-            results.append((test_case, "PASSED"))
-        else:
-            print "- FAILED"
-            results.append((test_case, result))
-        if eio_cosim_flag:
-            CimaProxy.resetCima()
-            # wait for Cima to be restarted
-            print "Wait for Cima to be rerestted" 
-            time.sleep(10)
+            impact = load_json_file(test_impact_file) or {}
+            test_jobs = select_impacted_jobs(test_jobs, changed_libs, impact)
+            print "Running %d tests impacted by %s" % \
+                (len(test_jobs), ' '.join(sorted(changed_libs)))
+
+    # The workers must not write in the same log file, when tests share
+    # the log file in parallel mode it is made unique with the position
+    # of the test in the run.
+    if jobs > 1 or options.serve:
+        log_count = Counter([job[4] for env, job in test_jobs])
+        test_jobs = [(env, job[:4] + ('%s.%d' % (job[4], pos),))
+                     if log_count[job[4]] > 1 else (env, job)
+                     for pos, (env, job) in enumerate(test_jobs)]
+
+    results_fp = None
+    if options.results:
+        results_fp = open(options.results, 'w')
+
+    pool = None
+    if options.serve:
+        run_info = {'asics': asics, 'dvpp_rels': asic_dvpp_rels,
+                    'limits': limits, 'port_mode': port_mode,
+                    'result_cache': result_cache_dir,
+                    'lib_dir': not options.no_lib_dir,
+                    'compress_logs': bool(options.compress_logs)}
+        try:
+            pool = TestCoordinator(options.serve, run_info, limits)
+        except socket.error, e:
+            print "ERROR: unable to serve on port %d: %s" % (options.serve, e)
+            sys.exit(1)
+    elif jobs > 1:
+        work_dir = '%s/logs/workers' % (get_spectra_root(binos_root))
+        pool = multiprocessing.Pool(jobs, init_worker,
+                                    (work_dir, test_index, test_environs))
+    elif eio_cosim_flag:
+        cima_session = CimaSession(*cima_endpoint)
+
+    results = [None] * len(test_jobs)
+    executed = []
+    flaky = load_json_file(test_flaky_file) or {}
+    retry_budget = options.retry_budget
+    try:
+        indexed_jobs = list(enumerate(test_jobs))
+        if pool:
+            history = load_json_file(test_history_file) or {}
+            indexed_jobs = schedule_test_jobs(indexed_jobs, history)
+        for pos, record in execute_test_jobs(pool, indexed_jobs, results_fp):
+            results[pos] = record
+            executed.append(record)
+
+        for attempt in range(1, options.retries + 1):
+            retry_positions = get_retry_positions(results, flaky, retry_budget)
+            if not retry_positions:
+                break
+            retry_budget -= len(retry_positions)
+            print "Retrying %d failed tests (attempt %d)" % \
+                (len(retry_positions), attempt)
+            # Keep the log of the failed attempt.
+            for pos in retry_positions:
+                log_file = test_jobs[pos][1][4]
+                rename_log(log_file, '%s.attempt%d' % (log_file, attempt))
+            for pos, record in execute_test_jobs(pool,
+                                    [(pos, get_retry_job(test_jobs[pos]))
+                                     for pos in retry_positions], results_fp,
+                                    retry=True):
+                executed.append(record)
+                results[pos] = record
+    except KeyboardInterrupt:
+        if pool:
+            pool.terminate()
+            pool.join()
+        sys.exit(1)
+    if pool:
+        pool.close()
+        pool.join()
 
     if eio_cosim_flag:
-        CimaProxy.killCima()
-    print
-    print "Results Doppler%s Test Count: %d" % (asic, len(results))
-    print "+---------------------------------------------------+"
-    for test_case,result in results:
-        print "| %-40s | %6s |" % (test_case, result)
-    print "+---------------------------------------------------+"
-    print
+        cima_session.kill()
+
+    if results_fp:
+        results_fp.close()
+
+    # The runs of the other asics update the same files at the same time.
+    update_json_file(test_history_file,
+                     lambda history: update_test_history(history, executed))
+    update_json_file(test_impact_file,
+                     lambda impact: update_test_impact(impact, executed))
+    update_json_file(test_flaky_file,
+                     lambda flaky: update_test_flakiness(flaky, executed))
+
+    asic_results = dict([(asic, []) for asic in asics])
+    for record in results:
+        asic_results[record['asic']].append(record)
+    for asic in asics:
+        print_results(asic, asic_results[asic])
+    if len(asics) > 1:
+        print_result_matrix(asics, asic_results)
+    flaky_results = [record for record in results
+                     if record['result'] == "PASSED (flaky)"]
+    if flaky_results:
+        print "Flaky tests (passed on retry):"
+        for record in flaky_results:
+            print "  Doppler%s %s %s" % (record['asic'], record['test'],
+                                        record['run_opts'])
+        print
+    print_top_tests(results, options.top)
+    clusters = cluster_failures(results)
+    if clusters:
+        signatures, new = update_json_file(
+            failure_signature_file,
+            lambda signatures: (signatures,
+                                update_failure_signatures(signatures,
+                                                          clusters)))
+        print_failure_clusters(clusters, signatures, new)
+    if options.junit:
+        write_junit_results(options.junit, asics, asic_results)
 
 if __name__ == '__main__':
     main()
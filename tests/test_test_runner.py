@@ -0,0 +1,349 @@
+'''
+Tests of test_runner.py, run with:
+    python -m unittest discover -s tests
+'''
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import test_runner
+
+
+class ParseRegressTest(unittest.TestCase):
+    def test_parse_regress_line(self):
+        # The entries as the regression files have them, the results are
+        # the same as the test entries the earlier parser produced.
+        self.assertEqual(test_runner.parse_regress_line('L2Basic,'),
+                         ('L2Basic', None, False))
+        self.assertEqual(test_runner.parse_regress_line('    L2Basic ;'),
+                         ('L2Basic', None, False))
+        self.assertEqual(test_runner.parse_regress_line(
+            'L2Basic_feature, "WAIT=1 TESTMODE=FEATURE"'),
+            ('L2Basic', 'WAIT=1 TESTMODE=FEATURE', False))
+        self.assertEqual(test_runner.parse_regress_line(
+            '"TESTNAME=L3Basic WAIT=1",'), ('L3Basic', 'WAIT=1', False))
+        self.assertEqual(test_runner.parse_regress_line(
+            'L3Basic_commit, "WAIT=1" + COMMIT'), ('L3Basic', 'WAIT=1', True))
+        self.assertEqual(test_runner.parse_regress_line('L2Basic, + COMMIT'),
+                         ('L2Basic', None, True))
+        for line in ['', 'l2_suite = ', '# L2Basic,', 'AAL_Basic,',
+                     'FEATURE_Basic,', 'l2_list,', 'L2Basic']:
+            self.assertEqual(test_runner.parse_regress_line(line), None)
+
+    def test_parse_regress_line_changed(self):
+        # An underscore entry without quoted run_opts used to be glued onto
+        # the next test name, it is a test with the default run_opts.
+        self.assertEqual(test_runner.parse_regress_line('L2Basic_vlan,'),
+                         ('L2Basic', None, False))
+        # TESTNAME without run_opts.
+        self.assertEqual(test_runner.parse_regress_line('"TESTNAME=L3Basic",'),
+                         ('L3Basic', '', False))
+
+    def test_parse_regress_file(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            regress_file = os.path.join(tmp, 'dopplercs_paq.regress')
+            f = open(regress_file, 'w')
+            f.write('L2Basic,\n'
+                    'l2_suite = \n'
+                    'L2Basic_feature, "WAIT=1 TESTMODE=FEATURE"\n'
+                    'L2mV4Forward, + COMMIT\n'
+                    '\n'
+                    'l3_suite = \n'
+                    '"TESTNAME=L3Basic WAIT=1",\n')
+            f.close()
+            records = [('L2Basic', None, None, False),
+                       ('L2Basic', 'WAIT=1 TESTMODE=FEATURE', 'l2_suite',
+                        False),
+                       ('L2mV4Forward', None, 'l2_suite', True),
+                       ('L3Basic', 'WAIT=1', 'l3_suite', False)]
+            cache_file = os.path.join(tmp, 'cache')
+            self.assertEqual(test_runner.parse_regress_file(regress_file,
+                                                            cache_file),
+                             records)
+            # From the cache.
+            self.assertEqual(test_runner.parse_regress_file(regress_file,
+                                                            cache_file),
+                             records)
+        finally:
+            shutil.rmtree(tmp)
+
+
+class VerdictTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.tmp, 'L2Basic.CS..log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write_log(self, text):
+        f = open(self.log_file, 'a')
+        f.write(text)
+        f.close()
+
+    def test_merge_verdict(self):
+        self.assertEqual(test_runner.merge_verdict(None, "PASSED"), "PASSED")
+        self.assertEqual(test_runner.merge_verdict(
+            "PASSED", "FAILED - PACKET_MISMATCH"), "FAILED - PACKET_MISMATCH")
+        self.assertEqual(test_runner.merge_verdict(
+            "FAILED - PACKET_MISMATCH", "PASSED"), "FAILED - PACKET_MISMATCH")
+
+    def test_scanner(self):
+        # The log is scanned while the test writes it, the verdicts split
+        # across the writes and the reads are found once.
+        scanner = test_runner.LogScanner(self.log_file)
+        self.assertEqual(scanner.scan(), None)
+        self.write_log('Running L2Basic\nSimulation PA')
+        self.assertEqual(scanner.scan(), None)
+        self.write_log('SSED\n' + 'x' * 100 + '\n')
+        self.assertEqual(scanner.scan(block_size=16), "PASSED")
+        self.assertEqual(scanner.scan(), "PASSED")
+        # A failure printed after PASSED fails the test.
+        self.write_log('Mismatch in packets sent and received\n')
+        self.assertEqual(scanner.scan(block_size=16),
+                         "FAILED - PACKET_MISMATCH")
+        # A failure is final, the rest of the log is not read.
+        offset = scanner.offset
+        self.write_log('Simulation PASSED\n')
+        self.assertEqual(scanner.scan(), "FAILED - PACKET_MISMATCH")
+        self.assertEqual(scanner.offset, offset)
+
+    def test_run_command(self):
+        cmd = 'echo Simulation PASSED; echo Mismatch in packets sent and ' \
+              'received; echo Simulation PASSED'
+        for compress in (False, True):
+            test_runner.remove_log(self.log_file)
+            exit_code, timed_out, rusage, libs, verdict = \
+                test_runner.run_command(cmd, self.log_file, (0, 0, 0),
+                                        test_runner.dp_verdicts,
+                                        compress=compress)
+            self.assertEqual(exit_code, 0)
+            self.assertFalse(timed_out)
+            self.assertEqual(verdict, "FAILED - PACKET_MISMATCH")
+
+    def test_scan_log_tail(self):
+        # The non DP tests are judged by the last verdict of the log.
+        self.assertEqual(test_runner.scan_log_tail(
+            self.log_file, test_runner.non_dp_verdicts), None)
+        self.write_log('FAILED (failures=1)\n' + 'x' * 100 + '\n')
+        self.assertEqual(test_runner.scan_log_tail(
+            self.log_file, test_runner.non_dp_verdicts), "FAILED")
+        self.write_log('SUMMARY: PASSED\n' + 'y' * 100 + '\n')
+        for block_size in (7, 16, 1024):
+            self.assertEqual(test_runner.scan_log_tail(
+                self.log_file, test_runner.non_dp_verdicts, block_size),
+                "PASSED")
+        self.write_log('no verdict in this block\n' * 10)
+        self.assertEqual(test_runner.scan_log_tail(
+            self.log_file, test_runner.non_dp_verdicts, 16), "PASSED")
+
+
+class CompressedLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.log_member_size = test_runner.log_member_size
+        # Small members so the log is several gzip members.
+        test_runner.log_member_size = 1000
+
+    def tearDown(self):
+        test_runner.log_member_size = self.log_member_size
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip(self):
+        log_file = os.path.join(self.tmp, 'L2Basic.CS..log')
+        lines = ['line %d of the simulation output\n' % (i)
+                 for i in range(500)]
+        lines[100] = 'Simulation PASSED\n'
+        lines[400] = 'Mismatch in packets sent and received\n'
+        content = ''.join(lines)
+
+        log = test_runner.CompressedLog(log_file)
+        # Writes of odd sizes, the verdicts are split across the writes.
+        pos = 0
+        while pos < len(content):
+            log.write(content[pos:pos + 77])
+            pos += 77
+        log.close()
+
+        self.assertFalse(os.path.exists(log_file))
+        self.assertEqual(test_runner.get_log_path(log_file), log_file + '.gz')
+        f = gzip.open(log_file + '.gz')
+        self.assertEqual(f.read(), content)
+        f.close()
+
+        index = test_runner.load_log_index(log_file)
+        self.assertEqual(index['size'], len(content))
+        self.assertTrue(len(index['members']) > 1)
+        self.assertEqual(index['verdict'], "FAILED - PACKET_MISMATCH")
+        self.assertEqual(index['marks'],
+                         [[content.index('Simulation PASSED'), "PASSED"],
+                          [content.index('Mismatch in packets'),
+                           "FAILED - PACKET_MISMATCH"]])
+
+        # A region of the log is read from the member it is in.
+        for offset, verdict in index['marks']:
+            self.assertEqual(test_runner.read_log(log_file, offset, 17),
+                             content[offset:offset + 17])
+        self.assertEqual(test_runner.read_log(log_file, 12345),
+                         content[12345:])
+        self.assertEqual(test_runner.read_log_tail(log_file, 200),
+                         content[-200:].splitlines()[1:])
+
+
+class CimaSessionTest(unittest.TestCase):
+    '''
+    Run the Cima session against a stand-in of the XML-RPC server of the
+    UCS.
+    '''
+    def setUp(self):
+        self.cima_reset_wait = test_runner.cima_reset_wait
+        test_runner.cima_reset_wait = 0.5
+        self.probes = 0
+        self.resets = 0
+        self.server = SimpleXMLRPCServer(('localhost', 0), allow_none=True,
+                                         logRequests=False)
+        self.server.register_function(self.reset_cima, 'resetCima')
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        test_runner.cima_reset_wait = self.cima_reset_wait
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def reset_cima(self):
+        self.resets += 1
+        return True
+
+    def is_cima_ready(self):
+        # Ready on the third probe after the reset.
+        self.probes += 1
+        return self.probes >= 3
+
+    def get_session(self):
+        return test_runner.CimaSession('localhost',
+                                       str(self.server.server_address[1]))
+
+    def test_wait_ready(self):
+        self.server.register_function(self.is_cima_ready, 'isCimaReady')
+        session = self.get_session()
+        # No reset yet, nothing to wait for.
+        self.assertTrue(session.wait_ready())
+        self.assertEqual(self.probes, 0)
+        session.reset()
+        self.assertEqual(self.resets, 1)
+        self.assertTrue(session.wait_ready())
+        self.assertEqual(self.probes, 3)
+        self.assertTrue(session.wait_ready())
+        self.assertEqual(self.probes, 3)
+
+    def test_wait_ready_without_probe(self):
+        # The server has no isCimaReady(), the session waits the fixed
+        # reset time.
+        session = self.get_session()
+        self.assertEqual(session.is_ready(), None)
+        session.reset()
+        start = time.time()
+        self.assertTrue(session.wait_ready())
+        self.assertTrue(time.time() - start >= 0.4)
+        self.assertEqual(self.resets, 1)
+
+
+class DistributedRunTest(unittest.TestCase):
+    '''
+    Run a coordinator with worker slots on this host. The tests of the
+    workers only write their log, no simulator is started.
+    '''
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        self.run_test_job = test_runner.run_test_job
+        self.log_chunk_size = test_runner.log_chunk_size
+        test_runner.run_test_job = self.fake_run_test_job
+        # Small chunks so the logs are sent in several chunks.
+        test_runner.log_chunk_size = 7
+
+    def tearDown(self):
+        test_runner.run_test_job = self.run_test_job
+        test_runner.log_chunk_size = self.log_chunk_size
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def fake_run_test_job(self, test_job):
+        env, (idx, count, test_case, run_opts, log_file) = test_job
+        if env[5]:
+            f = test_runner.CompressedLog(log_file)
+        else:
+            f = open(log_file, 'w')
+        f.write('Running %s\nSimulation PASSED\n' % (test_case))
+        f.close()
+        return test_runner.test_record(env[1], test_case, run_opts, "PASSED",
+                                       test_runner.get_log_path(log_file),
+                                       time.time(), 0)
+
+    def run_workers(self, compress_logs):
+        limits = (0, 0, 0)
+        env = (self.tmp, 'CS', False, limits, None, compress_logs)
+        log_dir = os.path.join(self.tmp, 'coordinator')
+        os.makedirs(log_dir)
+        tests = ['L2Basic', 'L3Basic', 'PACLBasic', 'RACLBasic', 'L3mV4Route']
+        indexed_jobs = [(pos, (env, (pos, len(tests), test, '',
+                                     '%s/%s.log' % (log_dir, test))))
+                        for pos, test in enumerate(tests)]
+
+        coordinator = test_runner.TestCoordinator(0, {}, limits)
+        url = 'http://localhost:%d/' % (coordinator.server.server_address[1])
+        hosts = ['host1', 'host2']
+        slots = [threading.Thread(target=test_runner.run_worker_slot,
+                                  args=(url, host, {'CS': env},
+                                        os.path.join(self.tmp, host), {},
+                                        {'CS': {}}))
+                 for host in hosts]
+        for slot in slots:
+            slot.start()
+        try:
+            results = dict(coordinator.imap_unordered(None, indexed_jobs))
+        finally:
+            coordinator.close()
+            for slot in slots:
+                slot.join()
+
+        self.assertEqual(sorted(results.keys()), range(len(tests)))
+        for pos, test in enumerate(tests):
+            record = results[pos]
+            self.assertEqual(record['test'], test)
+            self.assertEqual(record['result'], "PASSED")
+            self.assertTrue(record['host'] in hosts)
+            # The log of the worker is sent back to the coordinator.
+            log_file = '%s/%s.log' % (log_dir, test)
+            self.assertEqual(record['log'],
+                             test_runner.get_log_path(log_file))
+            self.assertFalse(os.path.islink(record['log']))
+            self.assertEqual(test_runner.read_log(log_file),
+                             'Running %s\nSimulation PASSED\n' % (test))
+        return sorted(os.listdir(log_dir))
+
+    def test_local_workers(self):
+        self.assertEqual(self.run_workers(False),
+                         ['L2Basic.log', 'L3Basic.log', 'L3mV4Route.log',
+                          'PACLBasic.log', 'RACLBasic.log'])
+
+    def test_local_workers_compressed(self):
+        files = self.run_workers(True)
+        self.assertEqual(len(files), 10)
+        for name in files:
+            self.assertTrue(name.endswith('.log.gz') or
+                            name.endswith('.log.gz.idx'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -32,9 +32,17 @@ import subprocess
 import datetime
 import time
 import filecmp
+import json
+import re
+import gzip
+import collections
+import hashlib
 from subprocess import check_output
+import log_search
+from state_files import load_json_file, save_json_file, file_digest
 
 regression_repo = "/auto/ecsg-paq1/sdk_regression/"
+crashPatterns = [r"Segmentation fault", r"core dumped", r"Aborted"]
 test_runner_exe = "/ws/siche-sjc/macallan/test_runner.py"
 
 ######################################################################
@@ -130,17 +138,137 @@ def scriptsDir(binos_root):
 def logDir(binos_root):
     return "%s/logs/" % (spectraDir(binos_root))
 
-def resultDir(binos_root):
-    return "%s/results/" % (spectraDir(binos_root))
+# The asics are tested in parallel on the same BINOS_ROOT, each one has
+# its own results.
+def resultDir(binos_root, asic):
+    return "%s/results/%s/" % (spectraDir(binos_root), asic)
+
+def resultsFile(binos_root, asic):
+    return "%s/test_runner.%s.jsonl" % (logDir(binos_root), asic)
+
+######################################################################
+# Track the inputs of the spectra build. The source files of every
+# spectra library are fingerprinted with their md5 after each
+# successful build. When only library sources changed since then the
+# workspace is not cleaned, the build only rebuilds what changed, and
+# when nothing changed the build is skipped. A change of the build
+# flags, of the toolchain, of any other source file of the SDK (shared
+# headers, build files) or of the binos root libraries spectra links
+# with is a full clean build. The md5 of the files is kept in the
+# digest file of the workspace.
+######################################################################
+spectraLibs = ["ngwcutils", "sdm", "rm_common", "rm_iml", "rmc", "rms",
+               "afd", "ral", "spectraapp", "spectrainfra", "spectra_swig",
+               "asd2", "cad"]
+buildSkipDirs = set(["logs", "results", "obj", "build", ".ACMEROOT"])
+buildOutputExts = (".o", ".so", ".a", ".d", ".pyc", ".log", ".gcda",
+                   ".gcno")
+binosLibDirs = ["usr/binos/lib", "usr/binos/lib64"]
+
+def buildStateFile(binos_root, asic):
+    return "%s/.spectra%s-build" % (spectraDir(binos_root),
+                                    asic.replace("Doppler", ""))
+
+def fileDigestFile(binos_root):
+    return "%s/.spectra-build-digests" % (spectraDir(binos_root))
+
+def get_build_fingerprint (env):
+    '''
+    Get the fingerprint of the build inputs: the 'global' md5 of the build
+    flags, the toolchain, the binos root libraries and the SDK sources of
+    no spectra library, and the 'libs' md5 of the source files of each
+    spectra library. The files named with a dot are the state of the
+    build and of the test runs, they are not build inputs.
+    '''
+    binos_root, asic, new_code, no_attach, cflow = env
+    sdkRoot = "%s/platforms/ngwc/doppler_sdk" % (binos_root)
+    digestCache = load_json_file(fileDigestFile(binos_root)) or {}
+    paths = []
+
+    globalMd5 = hashlib.md5()
+    globalMd5.update("asic %s new_code %s cflow %s\n" % (asic, new_code, cflow))
+    try:
+        globalMd5.update(check_output("gcc --version", shell=True,
+                                      stderr=subprocess.STDOUT))
+    except (subprocess.CalledProcessError, OSError):
+        pass
+    for libDir in binosLibDirs:
+        libDir = "%s/linkfarm/x86_64/%s" % (binos_root, libDir)
+        if not os.path.isdir(libDir):
+            continue
+        for fname in sorted(os.listdir(libDir)):
+            path = os.path.join(libDir, fname)
+            if ".so" in fname and os.path.isfile(path):
+                paths.append(path)
+                globalMd5.update("%s %s\n" % (fname, file_digest(path,
+                                                               digestCache)))
+    libMd5s = {}
+    for root, dirs, fnames in os.walk(sdkRoot):
+        dirs[:] = sorted([d for d in dirs
+                          if d not in buildSkipDirs and not d.startswith('.')])
+        components = root[len(sdkRoot):].split('/')
+        libs = [c for c in components if c in spectraLibs]
+        for fname in sorted(fnames):
+            if fname.endswith(buildOutputExts) or fname.startswith('.'):
+                continue
+            path = os.path.join(root, fname)
+            if libs:
+                md5 = libMd5s.setdefault(libs[-1], hashlib.md5())
+            else:
+                md5 = globalMd5
+            if os.path.isfile(path):
+                paths.append(path)
+                md5.update("%s %s\n" % (path[len(sdkRoot):],
+                                        file_digest(path, digestCache)))
+
+    # Only the files of this build are kept, the digests of the files
+    # gone since the last build are dropped.
+    save_json_file(fileDigestFile(binos_root),
+                   dict([(path, digestCache[path]) for path in paths]))
+    return {'global': globalMd5.hexdigest(),
+            'libs': dict([(lib, md5.hexdigest())
+                          for lib, md5 in libMd5s.items()])}
+
+def get_changed_libs (last, fingerprint):
+    '''
+    Get the libraries changed since the last build, None when the build
+    must be done from scratch.
+    '''
+    if not last or last['global'] != fingerprint['global']:
+        return None
+    libs = set(last['libs'].keys() + fingerprint['libs'].keys())
+    return sorted([lib for lib in libs
+                   if last['libs'].get(lib) != fingerprint['libs'].get(lib)])
+
+def linkfarm_is_complete (binos_root, asic):
+    '''
+    Check every link of the spectra linkfarm of the asic resolves. The
+    links are absolute, they break when the workspace is moved.
+    '''
+    linkfarm = "%s/linkfarm/x86_64-spectra%s" % (binos_root,
+                                                 asic.replace("Doppler", ""))
+    if not os.path.isdir(linkfarm):
+        return False
+    for root, dirs, fnames in os.walk(linkfarm):
+        for name in dirs + fnames:
+            path = os.path.join(root, name)
+            if os.path.islink(path) and not os.path.exists(path):
+                return False
+    return True
 
 ######################################################################
-# Clean the worksapce and build the tree again from scratch
+# Clean the worksapce and build the tree again, from scratch only if
+# the build flags or toolchain changed.
 ######################################################################
 def cleanWorkspace(env):
     binos_root, asic, new_code, no_attach, cflow = env
 
     os.chdir(binos_root)
 
+    # The build is gone with the clean.
+    if os.path.exists(buildStateFile(binos_root, asic)):
+        os.remove(buildStateFile(binos_root, asic))
+
     # First clean the workspace
     cleanCmd = "%s/platforms/ngwc/doppler_sdk/tools/scripts/spectra_build.py -a %s -c -o -q" % \
                             (binos_root, asic)
@@ -167,7 +295,21 @@ def cleanAndBuild(env, coverage):
     
     os.chdir(binos_root)
 
-    cleanWorkspace(env)
+    fingerprint = get_build_fingerprint(env)
+    changed = get_changed_libs(load_json_file(buildStateFile(binos_root, asic)),
+                               fingerprint)
+    if changed is not None and not changed and \
+       not linkfarm_is_complete(binos_root, asic):
+        print "Spectra linkfarm has broken links, building from scratch"
+        changed = None
+    if changed is None:
+        cleanWorkspace(env)
+    elif not changed:
+        print "Spectra build is up to date"
+        return
+    else:
+        print "Incremental spectra build, changed: %s" % (' '.join(changed))
+
     # Now build spectra
     buildCmd = "%s/platforms/ngwc/doppler_sdk/tools/scripts/spectra_build.py -a %s" % \
                             (binos_root, asic)
@@ -182,6 +324,7 @@ def cleanAndBuild(env, coverage):
     except subprocess.CalledProcessError:
         print "#### Spectra build failed"
         sys.exit(1)
+    save_json_file(buildStateFile(binos_root, asic), fingerprint)
 
 
 def updateWorkspace(binos_root):
@@ -220,6 +363,24 @@ def parse_test_runner_output (output):
 
     return results
 
+def load_test_runner_results (results_file):
+    '''
+    Load the results written by test_runner with the --results option,
+    one JSON record per test. The tests completed are returned even if
+    test_runner did not finish.
+    '''
+    results = {}
+    try:
+        for line in open(results_file):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            results[record['test']] = record['result']
+    except IOError:
+        print "#### test_runner results %s not found" % (results_file)
+    return results
+
 def loop_utPrograms (binos_root, asic, utPrograms):
     utResults = {}
     # Run all programs in a loop and copy the logs to the results
@@ -278,7 +439,7 @@ def loop_utPrograms (binos_root, asic, utPrograms):
 ######################################################################
 # run SDK UT code and collect the results.
 ######################################################################
-def runTest(env, tool):
+def runTest(env, tool, rerun_failed=None, retries=0):
     binos_root, asic, new_code, no_attach, cflow = env
     valgrind, coverage = tool
 
@@ -299,28 +460,180 @@ def runTest(env, tool):
             os.remove(path)
 
     # Remove the results directory and created it before each run
-    if os.path.exists(resultDir(binos_root)):
-        shutil.rmtree(resultDir(binos_root))
-    os.makedirs(resultDir(binos_root))
+    if os.path.exists(resultDir(binos_root, asic)):
+        shutil.rmtree(resultDir(binos_root, asic))
+    os.makedirs(resultDir(binos_root, asic))
 
     utPrograms = [(t,t,"TESTMODE=FEATURE",t,'','') for t in get_wireless_testcases()]
     utPrograms = utPrograms[5:8]
 
 #    utResults = loop_utPrograms(binos_root, asic, utPrograms)
 
-    cmd = [test_runner_exe, '-p', '-a', asic,
-        '-t', ':'.join(get_wireless_testcases()), '-r', '"TESTMODE=FEATURE"']
+    # Remove the results of the previous run, test_runner does not write
+    # the file when it fails before running the tests. The results of the
+    # failed tests to rerun are moved aside if they are in that file.
+    results_file = resultsFile(binos_root, asic)
+    if rerun_failed and os.path.exists(results_file) and \
+       os.path.realpath(rerun_failed) == os.path.realpath(results_file):
+        rerun_failed = "%s.rerun" % (results_file)
+        os.rename(results_file, rerun_failed)
+    elif os.path.exists(results_file):
+        os.remove(results_file)
+    if rerun_failed:
+        # Only rerun the tests which did not pass in the earlier results.
+        cmd = [test_runner_exe, '-p', '-a', asic,
+            '--rerun-failed', rerun_failed, '--results', results_file,
+            '--compress-logs']
+    else:
+        cmd = [test_runner_exe, '-p', '-a', asic,
+            '-t', ':'.join(get_wireless_testcases()), '-r', '"TESTMODE=FEATURE"',
+            '--results', results_file, '--compress-logs']
+    # A test failing once and passing on a retry is reported flaky instead
+    # of failing the run.
+    cmd += ['--retries', str(retries)]
     print "\nExecuting(%s)" % cmd
     try:
         output = subprocess.check_output(cmd, stderr = subprocess.STDOUT)
     except subprocess.CalledProcessError as e:
         print "#### test_runner error: %s" % e
-    else:
-        test_runner_result = parse_test_runner_output(output)
-    utResults = {t:(False, False, '', test_runner_result[t]) for t in test_runner_result.keys()}
+    test_runner_result = load_test_runner_results(results_file)
+
+    # Look for the crashes in the logs of the failed tests.
+    failedLogs = dict([(log, test) for test, result, log in
+                       get_failed_test_logs(results_file)])
+    crashed = set([failedLogs[log] for log, found in
+                   log_search.search_logs(failedLogs.keys(), crashPatterns)])
+    utResults = {t:(False, t in crashed, '', test_runner_result[t]) for t in test_runner_result.keys()}
 
     return utResults
 
+######################################################################
+# Summarize the log of a failed test for the email. The log is read
+# once line by line, plain or gzip compressed, and only the first
+# error with the lines around it and one copy of each stack trace
+# are kept, so the memory does not depend on the size of the log.
+######################################################################
+summaryContext = 20
+summaryMaxTraces = 5
+summaryMaxTraceLines = 40
+summaryMaxLineLen = 300
+attachMaxSize = 256 * 1024
+# The digests of the failed tests attached to the email, one per
+# failure signature of test_runner.
+summaryMaxDigests = 10
+summaryMaxTotalSize = 1024 * 1024
+
+summaryErrorRe = re.compile(r'Mismatch in packets|[Aa]ssert|ERROR|Error|'
+                            r'FAILED|Segmentation fault|core dumped|'
+                            r'Traceback \(most recent call last\)')
+# Python traceback, the frames are indented, and gdb backtrace frames.
+summaryTraceStartRe = re.compile(r'^(Traceback \(most recent call last\)|'
+                                 r'#0 +)')
+summaryTraceLineRe = re.compile(r'^(  |\t|#\d+ +)')
+summaryAddressRe = re.compile(r'0x[0-9a-fA-F]+')
+
+def summarize_log (log_file, context=summaryContext):
+    '''
+    Get the digest of the log: the first error line with the context
+    lines before and after it, or the end of the log if there is no
+    error, and the stack traces found in the log with the number of
+    times each one is seen. The traces are compared without their
+    addresses.
+    '''
+    if os.path.exists(log_file + '.gz'):
+        log_file = log_file + '.gz'
+    if log_file.endswith('.gz'):
+        fp = gzip.open(log_file)
+    else:
+        fp = open(log_file)
+
+    before = collections.deque(maxlen=context)
+    region = []
+    regionLine = 0
+    after = 0
+    traces = collections.OrderedDict()
+    trace = None
+    lineNum = 0
+    for line in fp:
+        lineNum += 1
+        line = line.rstrip('\n')[:summaryMaxLineLen]
+
+        if trace is not None:
+            if summaryTraceLineRe.match(line) and \
+               len(trace) < summaryMaxTraceLines:
+                trace.append(line)
+                continue
+            # The line after the python frames is the exception.
+            if trace[0].startswith('Traceback') and line.strip():
+                trace.append(line)
+            key = summaryAddressRe.sub('0x?', '\n'.join(trace))
+            if key in traces:
+                traces[key][0] += 1
+            elif len(traces) < summaryMaxTraces:
+                traces[key] = [1, trace]
+            trace = None
+        if summaryTraceStartRe.match(line):
+            trace = [line]
+
+        if regionLine:
+            if after < context:
+                region.append(line)
+                after += 1
+        elif summaryErrorRe.search(line):
+            regionLine = lineNum
+            region = list(before) + [line]
+        else:
+            before.append(line)
+    fp.close()
+    if trace is not None:
+        key = summaryAddressRe.sub('0x?', '\n'.join(trace))
+        if key in traces:
+            traces[key][0] += 1
+        elif len(traces) < summaryMaxTraces:
+            traces[key] = [1, trace]
+
+    summary = "Full log: %s (%d lines)\n\n" % (log_file, lineNum)
+    if regionLine:
+        summary += "First error at line %d:\n" % (regionLine)
+    else:
+        summary += "No error found, end of the log:\n"
+        region = list(before)
+    summary += '\n'.join(region) + '\n'
+    if traces:
+        summary += "\nStack traces (%d unique):\n" % (len(traces))
+        for count, trace in traces.values():
+            summary += "\n[seen %d times]\n%s\n" % (count, '\n'.join(trace))
+    return summary
+
+
+def get_failed_test_logs (results_file):
+    '''
+    Get the (test, result, log, signature) of the failed tests from the
+    test_runner results, the last record of a test is its result. The
+    signature is the test name when the record has none.
+    '''
+    records = collections.OrderedDict()
+    try:
+        for line in open(results_file):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['test']] = record
+    except IOError:
+        return []
+    return [(test, record['result'], record['log'],
+             record.get('signature', test))
+            for test, record in records.items()
+            if not record['result'].startswith("PASSED")]
+
+
+def attach_text (outer, text, filename):
+    msg = MIMEText(text, _subtype='plain')
+    msg.add_header('Content-Disposition', 'attachment', filename=filename)
+    outer.attach(msg)
+
+
 ######################################################################
 # Email the results of the Tests which was run previously with the
 # runTest().
@@ -361,10 +674,12 @@ def emailTestResults(env, tool, results, email, bugs, cdets, start_time):
         emailBodyText += "\n\n" 
 
     
-    # Get workspace information
-    if os.path.exists(".workspace"):
-        os.remove(".workspace")
-    cmd = "acme desc -workspace -short > .workspace"
+    # Get workspace information, the file is per asic as the asics are
+    # tested in parallel.
+    workspaceFile = ".workspace.%s" % (asic)
+    if os.path.exists(workspaceFile):
+        os.remove(workspaceFile)
+    cmd = "acme desc -workspace -short > %s" % (workspaceFile)
     try:
         output = subprocess.check_call(cmd, stderr=subprocess.STDOUT, shell=True)
     except subprocess.CalledProcessError:
@@ -373,7 +688,7 @@ def emailTestResults(env, tool, results, email, bugs, cdets, start_time):
     workspace = ""
     devline = ""
     devline_ver = ""
-    for line in open(".workspace"):
+    for line in open(workspaceFile):
         if "Workspace" in line:
             workspace = line.split(":")[1] 
             workspace = workspace.strip() 
@@ -387,7 +702,7 @@ def emailTestResults(env, tool, results, email, bugs, cdets, start_time):
     emailBodyText += "\nSDK Workspace: %s (%s/%s)" % (workspace, devline, devline_ver)
 
 
-    emailBodyText += "\nResult Directory: %s\n" % (resultDir(binos_root))
+    emailBodyText += "\nResult Directory: %s\n" % (resultDir(binos_root, asic))
     tbl_format = '| {:<35} | {:<15} | {:<40} |'
     tblBorder = "\n+--------------------------------+--------------+------------------------------------------+"
     cronJobText += tblBorder 
@@ -406,7 +721,7 @@ def emailTestResults(env, tool, results, email, bugs, cdets, start_time):
         cronJobText += tbl_format.format(utName, test_runner_result, '') 
 
         if valgrind and utValgrind:
-            valgrindFile = resultDir(binos_root) + utName + "_Valgrind.txt"
+            valgrindFile = resultDir(binos_root, asic) + utName + "_Valgrind.txt"
             if not os.path.exists(valgrindFile):
                 cronJobText += "\nValgrind Analysis Data: %s_Valgrind.txt \
                                   (ERROR: File Not found)\n" % (utName)
@@ -424,23 +739,60 @@ def emailTestResults(env, tool, results, email, bugs, cdets, start_time):
 
     # FIXME DOPPLERE Not attaching results for E, remove when ready
     if (asic != "DopplerE") and not no_attach:
-        for filename in os.listdir(resultDir(binos_root)):
-            path = os.path.join(resultDir(binos_root), filename)
+        for filename in os.listdir(resultDir(binos_root, asic)):
+            path = os.path.join(resultDir(binos_root, asic), filename)
             if not os.path.isfile(path):
                 continue
             ctype, encoding = mimetypes.guess_type(path)
             if ctype is None or encoding is not None:
                 ctype = 'application/octect-stream'
             maintype, subtype = ctype.split('/', 1)
-            if maintype == 'text':
-                fp = open(path)
-                msg = MIMEText(fp.read(), _subtype=subtype)
-            else:
+            if maintype != 'text':
+                continue
+            if os.path.getsize(path) > attachMaxSize:
+                attach_text(outer, summarize_log(path),
+                            "%s.summary.txt" % (filename))
                 continue
+            fp = open(path)
+            msg = MIMEText(fp.read(), _subtype=subtype)
+            fp.close()
 
             msg.add_header('Content-Disposition', 'attachment', filename=filename)
             outer.attach(msg)
 
+        # Attach the digest of the log of the first failed test of every
+        # failure signature, within summaryMaxDigests and
+        # summaryMaxTotalSize, so a night with many failures does not
+        # bring back the oversized email.
+        clusters = collections.OrderedDict()
+        for test, result, log, signature in \
+                get_failed_test_logs(resultsFile(binos_root, asic)):
+            clusters.setdefault(signature, []).append((test, result, log))
+        attached = 0
+        totalSize = 0
+        for signature, failures in clusters.items():
+            logs = [(test, result, log) for test, result, log in failures
+                    if os.path.exists(log) or os.path.exists(log + '.gz')]
+            if not logs:
+                continue
+            if attached == summaryMaxDigests or \
+               totalSize >= summaryMaxTotalSize:
+                break
+            test, result, log = logs[0]
+            text = "Test: %s (%s)\n" % (test, result)
+            if len(failures) > 1:
+                text += "Same failure in: %s\n" % \
+                    (' '.join([failure[0] for failure in failures[1:]]))
+            text += summarize_log(log)
+            attach_text(outer, text, "%s.summary.txt" % (test))
+            attached += 1
+            totalSize += len(text)
+        if attached < len(clusters):
+            outer.attach(MIMEText("%d more failure signatures are not "
+                                  "summarized, see the logs in %s\n" %
+                                  (len(clusters) - attached,
+                                   resultDir(binos_root, asic)), "plain"))
+
     composed = outer.as_string()
     s = smtplib.SMTP('localhost')
     s.sendmail(email, email, composed)
@@ -463,7 +815,11 @@ def main():
                           "-f <cflow>\n"
                           "-c <cdets>\n"
                           "-s <skip clean and build>\n"
-                          "-r <skip clean after run>\n",
+                          "-r <skip clean after run, the default>\n"
+                          "-w <clean after run>\n"
+                          "-o <build only>\n"
+                          "-x <rerun failed tests of results file>\n"
+                          "-t <retries of a failed test>\n",
                           description="Nightly Build script")
     parser.add_option("-a", "--asic", dest="asic", help="ASIC type")
     parser.add_option("-b", "--binos_root", dest="binosroot",
@@ -484,7 +840,20 @@ def main():
                       help="Skip clean and build, directly run tests")
     parser.add_option("-c", "--cdets", dest="cdets", help="CDETS attachment")
     parser.add_option("-r", "--after-run", action="store_true",
-                      dest="after_run", help="skip clean after run")
+                      dest="after_run", help="skip clean after run, the \
+                      default, kept for the existing callers")
+    parser.add_option("-w", "--clean-after-run", action="store_true",
+                      dest="clean_after_run", help="Clean the workspace \
+                      after the run, the next build is a full build")
+    parser.add_option("-o", "--build-only", action="store_true",
+                      dest="build_only", help="Clean and build, do not run \
+                      the tests")
+    parser.add_option("-x", "--rerun-failed", dest="rerun_failed",
+                      help="Rerun the failed tests of the test_runner results \
+                      file of an earlier run")
+    parser.add_option("-t", "--retries", dest="retries", type="int", default=2,
+                      help="Number of times test_runner executes a failed \
+                      test again")
 
     asic = "DopplerCS"
     binos_root = ''
@@ -496,7 +865,7 @@ def main():
     skip = False
     cflow = False
     cdets = ""
-    after_run = False
+    clean_after_run = False
     
     (options, args) = parser.parse_args()
 
@@ -527,8 +896,10 @@ def main():
         cdets = options.cdets 
         print "SDK regression results will be attached to %s" % (cdets)
 
-    if options.after_run:
-        after_run = options.after_run
+    # The build is kept after the run by default so the next run only
+    # builds what changed, -r is the default.
+    if options.clean_after_run and not options.after_run:
+        clean_after_run = True
         
     if options.binosroot:
         binos_root = options.binosroot
@@ -576,19 +947,21 @@ def main():
     env = (binos_root, asic, new_code, no_attach, cflow)
     if not skip:
         cleanAndBuild(env, False)
+    if options.build_only:
+        return
 
     # Run without Valgrind
     tool = (False, False)
-    results = runTest(env, tool) 
+    results = runTest(env, tool, options.rerun_failed, options.retries)
     emailTestResults(env, tool, results, email, bugs, cdets, start_time)
 
-    if not after_run:
+    if clean_after_run:
         cleanWorkspace(env)
     
     # Run with Valgrind
     if valgrind:
         tool = (True, False)
-        results = runTest(env, tool) # run with valgrind
+        results = runTest(env, tool, retries=options.retries) # run with valgrind
         emailTestResults(env, tool, results, email, bugs, cdets, start_time)
 
 
@@ -11,12 +11,17 @@ import datetime
 import subprocess
 import shutil
 import sys
+import time
+import multiprocessing
+import hashlib
 from optparse import OptionParser
+from distutils.spawn import find_executable
 from collections import *
 import smtplib
 import mimetypes
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from state_files import load_json_file, save_json_file, file_digest
 
 wireless_regression_exe = "/ws/siche-sjc/macallan/wireless_regression.py"
 
@@ -27,10 +32,16 @@ def workspace_name(storage):
     now = datetime.date.today()
     view_tag = "SDKREG_%s" % (now.strftime('%m%d%Y'))
     workspace = "%s/%s" % (storage, view_tag)
+    return (view_tag,) + workspace_paths(workspace)
+
+def workspace_paths(workspace):
+    '''
+    Get the roots of the workspace.
+    '''
     binos_root = "%s/binos" % (workspace)
     ios_root = "%s/ios" % (workspace)
     sdk_root = "%s/platforms/ngwc/doppler_sdk" % (binos_root)
-    return (view_tag, workspace, binos_root, ios_root, sdk_root)
+    return (workspace, binos_root, ios_root, sdk_root)
 
 def workspace_version(workspace):
     '''
@@ -210,12 +221,466 @@ def patch_ws (workspace = '.'):
         except subprocess.CalledProcessError as e:
             print "Error: ", e
 
-def run_regression(storage, branch, email):
+######################################################################
+# Stages of the regression. Every stage is a command run once all
+# the stages it depends on succeeded, the stages of a failed stage
+# are skipped. A stage takes cpus and memory (GB) from the budget of
+# the run and may hold a lock shared with other stages, the spectra
+# builds of the asics share the binos tree. The stages are started
+# as soon as their dependencies are done and the budget allows, so
+# the tests of an asic run while the next asic builds.
+######################################################################
+Stage = namedtuple('Stage', 'name cmd cwd deps cpus mem lock')
+
+stage_poll_interval = 5
+
+def get_memory_gb():
+    '''
+    Get the memory of the host in GB.
+    '''
+    for line in open('/proc/meminfo'):
+        if line.startswith('MemTotal:'):
+            return int(line.split()[1]) / (1024 * 1024)
+    return 0
+
+def run_stages(stages, cpus, mem, log_dir, env):
+    '''
+    Run the stages within the cpus and mem budget, the output of each
+    stage is in <log_dir>/<stage>.log. Returns the dictionary of the
+    stage name to True, False if it failed or None if it was skipped.
+    '''
+    status = {}
+    running = {}
+    locks = set()
+    pending = list(stages)
+    while pending or running:
+        for stage in list(pending):
+            if [dep for dep in stage.deps
+                if dep in status and not status[dep]]:
+                print "Skipping %s" % (stage.name)
+                status[stage.name] = None
+                pending.remove(stage)
+                continue
+            if [dep for dep in stage.deps if dep not in status]:
+                continue
+            # A stage bigger than the budget runs alone.
+            stage_cpus = min(stage.cpus, cpus)
+            stage_mem = min(stage.mem, mem)
+            used_cpus = sum([min(s.cpus, cpus) for s, p, f in running.values()])
+            used_mem = sum([min(s.mem, mem) for s, p, f in running.values()])
+            if used_cpus + stage_cpus > cpus or used_mem + stage_mem > mem:
+                continue
+            if stage.lock and stage.lock in locks:
+                continue
+            print "Executing %s (%s)" % (stage.name, stage.cmd)
+            sys.stdout.flush()
+            log = open("%s/%s.log" % (log_dir, stage.name), "w")
+            proc = subprocess.Popen(stage.cmd, stdout=log,
+                                    stderr=subprocess.STDOUT, shell=True,
+                                    cwd=stage.cwd, env=env)
+            running[stage.name] = (stage, proc, log)
+            if stage.lock:
+                locks.add(stage.lock)
+            pending.remove(stage)
+
+        if not running:
+            if pending:
+                print "###Stages %s depend on unknown stages" % \
+                    (' '.join([stage.name for stage in pending]))
+                for stage in pending:
+                    status[stage.name] = None
+            break
+        time.sleep(stage_poll_interval)
+        for name, (stage, proc, log) in running.items():
+            if proc.poll() is None:
+                continue
+            log.close()
+            status[name] = proc.returncode == 0
+            if stage.lock:
+                locks.discard(stage.lock)
+            del running[name]
+            print "%s %s" % (name, "done" if status[name] else
+                             "###failed, see %s/%s.log" % (log_dir, name))
+            sys.stdout.flush()
+    return status
+
+######################################################################
+# Build artifact cache shared by the nightly workspaces. A build
+# output directory is stored under the key of what the build
+# consumes: the spectra build of an asic under the md5 of the SDK
+# sources, of the toolchain and of the content of the binos root
+# linkfarm it builds against, so a spectra build is reused when the
+# binos root changes are not seen by spectra. The binos root itself
+# is not cached, the nightly always runs on new commits and a key
+# over the whole ios and binos trees would almost never hit, it is
+# built incrementally in the reused workspace instead. The files are stored
+# once by their md5 in <cache>/objects and every key has a manifest
+# in <cache>/manifests listing the files of the directory, so the
+# files unchanged from one night to the next take no extra space. A
+# hit restores the directory instead of building it. The manifests
+# least recently used are evicted to keep the objects under the
+# disk budget. The md5 of the files is kept in the digest file of
+# the workspace with their size and mtime, a workspace reused for
+# the next night only reads the files which changed.
+######################################################################
+artifact_skip_dirs = set(['linkfarm', 'BUILD_LOGS', '.ACMEROOT', 'logs',
+                          'results'])
+artifact_output_exts = ('.o', '.so', '.a', '.d', '.pyc', '.log')
+
+def artifact_digest_file(workspace):
+    return "%s/.artifact-digests" % (workspace)
+
+def load_artifact_digests(workspace):
+    return load_json_file(artifact_digest_file(workspace)) or {}
+
+def save_artifact_digests(workspace, digests):
+    '''
+    Save the digests of the workspace, the digests of the files which do
+    not exist anymore are dropped.
+    '''
+    for rel_path in digests.keys():
+        if not os.path.exists(os.path.join(workspace, rel_path)):
+            del digests[rel_path]
+    save_json_file(artifact_digest_file(workspace), digests)
+
+def file_md5(path, workspace=None, digests=None):
+    '''
+    Get the md5 of the file. The digests of the workspace are used and
+    updated if provided, they are keyed by the path in the workspace.
+    '''
+    rel_path = None
+    if digests is not None:
+        rel_path = os.path.relpath(os.path.realpath(path),
+                                   os.path.realpath(workspace))
+    return file_digest(path, digests, rel_path)
+
+def tree_digest(roots, skip_paths=(), workspace=None, digests=None):
+    '''
+    Get the md5 of the source files under the roots, the build outputs
+    and the skip_paths are left out. The files and directories named
+    with a dot are the state of the builds and of the test runs, they are
+    left out too. The links into the workspace are taken relative to it,
+    they are the same in every workspace.
+    '''
+    md5 = hashlib.md5()
+    for top in roots:
+        for root, dirs, fnames in os.walk(top):
+            dirs[:] = sorted([d for d in dirs if d not in artifact_skip_dirs
+                              and not d.startswith('obj')
+                              and not d.startswith('.')
+                              and os.path.join(root, d) not in skip_paths])
+            for fname in sorted(fnames):
+                path = os.path.join(root, fname)
+                if fname.endswith(artifact_output_exts) or \
+                   fname.startswith('.'):
+                    continue
+                if os.path.islink(path):
+                    link = os.readlink(path)
+                    if workspace and is_within(link, workspace):
+                        link = os.path.relpath(link, workspace)
+                    md5.update('%s -> %s\n' % (path[len(top):], link))
+                elif os.path.isfile(path):
+                    md5.update('%s %s\n' % (path[len(top):],
+                                            file_md5(path, workspace, digests)))
+    return md5.hexdigest()
+
+def artifact_key(*inputs):
+    return hashlib.md5('\n'.join(inputs)).hexdigest()
+
+def toolchain_version():
+    '''
+    Get the version of the compiler the builds use, a build stored with
+    another toolchain is not reused.
+    '''
+    try:
+        return subprocess.check_output("gcc --version", shell=True,
+                                       stderr=subprocess.STDOUT)
+    except (subprocess.CalledProcessError, OSError):
+        return ''
+
+def artifact_manifest(cache_dir, key):
+    return '%s/manifests/%s.json' % (cache_dir, key)
+
+def artifact_object(cache_dir, md5):
+    return '%s/objects/%s/%s' % (cache_dir, md5[:2], md5)
+
+def is_within(path, root):
+    return path == root or path.startswith(root + '/')
+
+def walk_artifact(src, workspace):
+    '''
+    Walk the build output directory as it is stored in the cache, it is
+    restored in another workspace once this one is gone. Yields the
+    entries (path in the directory, kind, value):
+      'd': a directory, the value is None.
+      'f': a file, the value is the real path of the file. The links to
+           the files and directories of the workspace are walked as the
+           file or directory they point to.
+      'l': a link, the value is the link. The links within the directory
+           are relative to the link, the links out of the workspace are
+           kept as they are.
+    '''
+    real_src = os.path.realpath(src)
+    real_workspace = os.path.realpath(workspace)
+    # The directories to walk as (real path, path in the directory, real
+    # paths of the parents followed to get there).
+    pending = [(real_src, '', set([real_src]))]
+    while pending:
+        real_dir, rel_dir, parents = pending.pop(0)
+        for name in sorted(os.listdir(real_dir)):
+            path = os.path.join(real_dir, name)
+            rel_path = os.path.join(rel_dir, name)
+            target = os.path.realpath(path)
+            if os.path.islink(path):
+                if not os.path.exists(path):
+                    yield (rel_path, 'l', os.readlink(path))
+                    continue
+                link = os.path.normpath(os.path.join(real_dir,
+                                                     os.readlink(path)))
+                if is_within(link, real_src):
+                    yield (rel_path, 'l', os.path.relpath(
+                        link, os.path.join(real_src,
+                                           os.path.dirname(rel_path))))
+                    continue
+                if not is_within(target, real_workspace):
+                    yield (rel_path, 'l', target)
+                    continue
+            if os.path.isdir(target):
+                yield (rel_path, 'd', None)
+                if target not in parents:
+                    pending.append((target, rel_path,
+                                    parents | set([target])))
+            elif os.path.isfile(target):
+                yield (rel_path, 'f', target)
+
+def output_digest(src, workspace, digests=None):
+    '''
+    Get the md5 of the content of the build output directory, the files
+    behind its links included.
+    '''
+    md5 = hashlib.md5()
+    for rel_path, kind, value in walk_artifact(src, workspace):
+        if kind == 'f':
+            value = file_md5(value, workspace, digests)
+        md5.update('%s %s %s\n' % (rel_path, kind, value))
+    return md5.hexdigest()
+
+def restore_artifact(cache_dir, key, dest, workspace=None, digests=None):
+    '''
+    Restore the directory stored under the key in dest, replacing it.
+    The digests of the workspace are updated with the files restored if
+    provided. Returns False if the key is not in the cache.
+    '''
+    manifest_file = artifact_manifest(cache_dir, key)
+    manifest = load_json_file(manifest_file)
+    if manifest is None:
+        return False
+    # Mark the manifest as used for the eviction.
+    os.utime(manifest_file, None)
+    try:
+        if os.path.islink(dest):
+            os.remove(dest)
+        elif os.path.exists(dest):
+            shutil.rmtree(dest)
+        for entry in manifest:
+            path = os.path.join(dest, entry[0])
+            parent = os.path.dirname(path)
+            if not os.path.exists(parent):
+                os.makedirs(parent)
+            if entry[1] == 'd':
+                if not os.path.exists(path):
+                    os.makedirs(path)
+            elif entry[1] == 'l':
+                os.symlink(entry[2], path)
+            else:
+                shutil.copyfile(artifact_object(cache_dir, entry[2]), path)
+                os.chmod(path, entry[4])
+                if digests is not None:
+                    st = os.stat(path)
+                    digests[os.path.relpath(os.path.realpath(path),
+                                            os.path.realpath(workspace))] = \
+                        [st.st_size, st.st_mtime, entry[2]]
+    except (IOError, OSError), e:
+        print "###Unable to restore %s from the cache: %s" % (dest, e)
+        shutil.rmtree(dest, ignore_errors=True)
+        return False
+    return True
+
+def store_artifact(cache_dir, key, src, workspace, digests=None):
+    '''
+    Store the directory in the cache under the key, see walk_artifact().
+    '''
+    manifest = []
+    try:
+        for rel_path, kind, value in walk_artifact(src, workspace):
+            if kind != 'f':
+                manifest.append([rel_path, kind, value] if value is not None
+                                else [rel_path, kind])
+                continue
+            md5 = file_md5(value, workspace, digests)
+            obj = artifact_object(cache_dir, md5)
+            if not os.path.exists(obj):
+                if not os.path.exists(os.path.dirname(obj)):
+                    os.makedirs(os.path.dirname(obj))
+                shutil.copyfile(value, '%s.%d' % (obj, os.getpid()))
+                os.rename('%s.%d' % (obj, os.getpid()), obj)
+            st = os.stat(value)
+            manifest.append([rel_path, 'f', md5, st.st_size,
+                             st.st_mode & 07777])
+        manifest_file = artifact_manifest(cache_dir, key)
+        if not os.path.exists(os.path.dirname(manifest_file)):
+            os.makedirs(os.path.dirname(manifest_file))
+    except (IOError, OSError), e:
+        print "###Unable to store %s in the cache: %s" % (src, e)
+        return False
+    return save_json_file(manifest_file, manifest)
+
+def evict_artifacts(cache_dir, budget):
+    '''
+    Remove the manifests least recently used until the objects of the
+    others fit in the budget (bytes), then the objects no manifest uses.
+    '''
+    manifest_dir = '%s/manifests' % (cache_dir)
+    if not os.path.exists(manifest_dir):
+        return
+    manifests = []
+    for name in os.listdir(manifest_dir):
+        path = os.path.join(manifest_dir, name)
+        manifest = load_json_file(path)
+        if manifest is None:
+            continue
+        objects = dict([(entry[2], entry[3]) for entry in manifest
+                        if entry[1] == 'f'])
+        manifests.append((os.path.getmtime(path), path, objects))
+    manifests.sort()
+
+    def used_size(manifests):
+        used = {}
+        for mtime, path, objects in manifests:
+            used.update(objects)
+        return sum(used.values())
+
+    # The manifest used last is always kept.
+    while len(manifests) > 1 and used_size(manifests) > budget:
+        mtime, path, objects = manifests.pop(0)
+        print "Evicting %s from the build cache" % (os.path.basename(path))
+        os.remove(path)
+
+    used = set()
+    for mtime, path, objects in manifests:
+        used.update(objects.keys())
+    object_dir = '%s/objects' % (cache_dir)
+    for root, dirs, fnames in os.walk(object_dir):
+        for fname in fnames:
+            if fname not in used:
+                os.remove(os.path.join(root, fname))
+
+######################################################################
+# Workspace teardown. Removing a workspace of several GB takes long
+# on NFS, the workspace is renamed in the trash of the storage, which
+# is instant, and the trash is deleted by a background process at
+# the lowest CPU and I/O priority after the cron job is done. The
+# last workspaces may be kept, the run of the next night starts from
+# the newest one updated to the latest code when its workspace is
+# not there, so the builds and the digests of the kept workspace are
+# reused. The kept workspace is reused in place under its name, the
+# linkfarms, .ACMEROOT and the generated build files record the
+# absolute path of the workspace.
+######################################################################
+def trash_dir(storage):
+    return "%s/.trash" % (storage)
+
+def trash_workspace(storage, workspace):
+    '''
+    Move the workspace in the trash, it is removed right away if it can
+    not be moved.
+    '''
+    trash = trash_dir(storage)
+    if not os.path.exists(trash):
+        os.makedirs(trash)
+    try:
+        os.rename(workspace, "%s/%s.%d" % (trash, os.path.basename(workspace),
+                                           time.time()))
+    except OSError, e:
+        print "###Unable to move %s to the trash: %s" % (workspace, e)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+def empty_trash(storage):
+    '''
+    Delete the trash in a background process which is not waited for.
+    '''
+    trash = trash_dir(storage)
+    if not os.path.exists(trash) or not os.listdir(trash):
+        return
+    cmd = ['nice', '-n', '19', 'rm', '-rf'] + \
+        [os.path.join(trash, name) for name in os.listdir(trash)]
+    if find_executable('ionice'):
+        cmd = ['ionice', '-c', '3'] + cmd
+    devnull = open(os.devnull, 'r+')
+    subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull,
+                     close_fds=True, preexec_fn=os.setsid)
+    devnull.close()
+
+def get_workspaces(storage):
+    '''
+    Get the workspaces of the storage, the newest first.
+    '''
+    workspaces = []
+    for name in os.listdir(storage):
+        try:
+            date = datetime.datetime.strptime(name, "SDKREG_%m%d%Y")
+        except ValueError:
+            continue
+        workspaces.append((date, "%s/%s" % (storage, name)))
+    workspaces.sort(reverse=True)
+    return [workspace for date, workspace in workspaces]
+
+def reuse_workspace(storage, branch):
+    '''
+    Get the newest workspace kept by the previous runs updated to the
+    latest code. Returns None if there is no workspace to reuse or if it
+    can not be updated.
+    '''
+    kept = get_workspaces(storage)
+    if not kept:
+        return None
+    workspace = kept[0]
+    print "Starting from the workspace %s" % (workspace)
+    os.environ['ACME_VERBOSITY'] = 'terse'
+    cmd = "acme update -comp binos@%s/latest" % (branch)
+    try:
+        subprocess.check_call(cmd, stderr=subprocess.STDOUT, shell=True,
+                              cwd=workspace)
+    except subprocess.CalledProcessError:
+        print "###Error in updating the workspace %s" % (workspace)
+        trash_workspace(storage, workspace)
+        return None
+    finally:
+        os.environ['ACME_VERBOSITY'] = 'normal'
+    return workspace
+
+def retire_workspaces(storage, keep):
+    '''
+    Keep the last keep workspaces of the storage and move the older ones
+    in the trash.
+    '''
+    for workspace in get_workspaces(storage)[keep:]:
+        print "Removing workspace %s" % (workspace)
+        trash_workspace(storage, workspace)
+    empty_trash(storage)
+
+def run_regression(storage, branch, email, cpus, mem, cache_dir=None,
+                   cache_size=0, keep=0):
     '''
     This routine will create the workspace from latest and build the
     binos linkfarm and spectra targets. Then it will launch the regression
     of the software against a standard DVPP release for that ASIC. The
-    results will be sent to the alias or email provide.
+    results will be sent to the alias or email provide. The builds and
+    the tests are run as stages within the cpus and mem (GB) budget.
+    The builds found in the cache_dir are restored instead of built and
+    the builds done are stored in it, within cache_size GB. The last keep
+    workspaces are kept, the older ones are removed. When the workspace
+    is not there the run is done in the newest workspace kept.
     '''
     # Create workspace in storage area and pull the workspace
     view_tag, workspace, binos_root, ios_root, sdk_root = workspace_name(storage)
@@ -225,6 +690,13 @@ def run_regression(storage, branch, email):
 #        print 'Workspace %s removed' % (workspace)
 
 #    os.makedirs(workspace)
+    if not os.path.exists(workspace):
+        reused = reuse_workspace(storage, branch)
+        if not reused:
+            print "###No workspace %s to run the regression in" % (workspace)
+            send_email_ws(email)
+            return False
+        workspace, binos_root, ios_root, sdk_root = workspace_paths(reused)
     os.chdir(workspace)
 
     # Set path for the BINOS build, 
@@ -287,39 +759,75 @@ def run_regression(storage, branch, email):
     bugs_file_p.write(bugs_info)
     bugs_file_p.close()
 
-    # Start the build for the x86_64_binos_root.
-    # Once the binos_root is done build all ASIC builds
-    cmd = "mcp_ios_precommit -- -j16 build_x86_64_binos_root"
-    print "Executing (%s)" % (cmd)
-    os.chdir("%s/sys" % (ios_root))
-    try:
-        subprocess.check_call(
-            cmd, stderr=subprocess.STDOUT, shell=True, env=d_env)
-    except subprocess.CalledProcessError:
+    # Build the x86_64_binos_root, once it is done build the ASICs
+    # for the new AFD/CAD one after the other and execute the regression
+    # of each ASIC as soon as it is built. The spectra builds in the
+    # cache are restored instead.
+    binos_cmd = "mcp_ios_precommit -- -j16 build_x86_64_binos_root"
+    outputs = {'binos_root': "%s/linkfarm/x86_64" % (binos_root)}
+    keys = {}
+    digests = None
+    status = run_stages([Stage('binos_root', binos_cmd,
+                               "%s/sys" % (ios_root), [], 16, 16, None)],
+                        cpus, mem, log_dir, d_env)
+
+    if not status['binos_root']:
         print "###Error in building binos linkfarm"
         # Send email for build failure
         send_email_binos_root(email, binos_root, bugs_file)
-        shutil.rmtree(workspace)
+        trash_workspace(storage, workspace)
+        empty_trash(storage)
         return False
 
-    # Start the ASIC builds for the new AFD/CAD and execute the regressions
+    # The spectra builds are keyed by the content of the binos root
+    # linkfarm they build against, now that it is complete.
+    if cache_dir:
+        print "Looking up the spectra builds in the cache %s" % (cache_dir)
+        digests = load_artifact_digests(workspace)
+        binos_digest = output_digest(outputs['binos_root'], workspace, digests)
+        sdk_digest = tree_digest([sdk_root], (), workspace, digests)
+        toolchain = toolchain_version()
+    stages = []
     for asic in ['CS', 'D']:
         cmd = "%s -b %s -a Doppler%s -e %s -k %s -n -p" % \
             (wireless_regression_exe, 
              binos_root, asic, email, bugs_file)
+        build = 'build_%s' % (asic)
+        outputs[build] = "%s/linkfarm/x86_64-spectra%s" % (binos_root, asic)
+        if cache_dir:
+            keys[build] = artifact_key(binos_digest, asic, "-p", sdk_digest,
+                                       toolchain)
+        if not cache_dir or not restore_artifact(cache_dir, keys[build],
+                                                 outputs[build]):
+            stages.append(Stage(build, "%s -o" % (cmd), binos_root, [],
+                                8, 8, 'binos_tree'))
+        else:
+            print "Restored spectra Doppler%s from the cache" % (asic)
+        # The workspace is removed at the end, no clean after the run. The
+        # binos root the tests load the libraries of is complete already.
+        stages.append(Stage('test_%s' % (asic), "%s -s -r" % (cmd), binos_root,
+                            [stage.name for stage in stages
+                             if stage.name == build], 2, 4, None))
+    status.update(run_stages(stages, cpus, mem, log_dir, d_env))
+
+    if cache_dir:
+        for name in ['build_CS', 'build_D']:
+            if status.get(name):
+                print "Storing %s in the cache" % (name)
+                store_artifact(cache_dir, keys[name], outputs[name],
+                               workspace, digests)
+        evict_artifacts(cache_dir, cache_size * 1024 * 1024 * 1024)
+        save_artifact_digests(workspace, digests)
 
-        try:
-            print "Executing (%s)" % (cmd)
-            subprocess.check_call(
-                cmd, stderr=subprocess.STDOUT, shell=True, env=d_env)
-        except subprocess.CalledProcessError:
-            print "###Error in executing regression for spectra Doppler%s (new AFD/RAL)" % (asic)
+    for asic in ['CS', 'D']:
+        if not status.get('build_%s' % (asic), True):
+            print "###Error in building spectra Doppler%s (new AFD/RAL)" % (asic)
             send_email_asic_build(email, binos_root, asic, bugs_file, False)
-            
-        continue
+        elif not status['test_%s' % (asic)]:
+            print "###Error in executing regression for spectra Doppler%s (new AFD/RAL)" % (asic)
 
     update_current_label(label_dir, "last_label", current_label)
-    shutil.rmtree(workspace)
+    retire_workspaces(storage, keep)
     return True
 
 ######################################################################
@@ -333,12 +841,32 @@ def main():
     parser = OptionParser(usage="usage: %prog\n"
                           "-e <email address>\n"
                           "-s <storage>\n"
-                          "-b <branch>\n",
+                          "-b <branch>\n"
+                          "-j <cpus>\n"
+                          "-m <memory in GB>\n"
+                          "-c <build cache directory>\n"
+                          "-z <build cache size in GB>\n"
+                          "-k <workspaces kept>\n",
                           description="SDK regression cron program")
     parser.add_option("-e", "--email", dest="email", help="Email Address")
     parser.add_option("-s", "--storage", dest="storage",
                       help="Starage for the worksapce")
     parser.add_option("-b", "--branch", dest="branch", help="Branch name")
+    parser.add_option("-j", "--cpus", dest="cpus", type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="CPUs the builds and tests may use at once")
+    parser.add_option("-c", "--cache", dest="cache",
+                      help="Directory of the build cache shared by the \
+                      workspaces, the builds are not cached if not given")
+    parser.add_option("-z", "--cache-size", dest="cache_size", type="int",
+                      default=200, help="Disk budget of the build cache in GB")
+    parser.add_option("-k", "--keep", dest="keep", type="int", default=0,
+                      help="Number of the last workspaces kept, the next \
+                      run starts from the newest one if its workspace is not \
+                      there. The older ones are removed in the background")
+    parser.add_option("-m", "--memory", dest="memory", type="int",
+                      help="Memory in GB the builds and tests may use at \
+                      once, by default the memory of the host")
     (options, args) = parser.parse_args()
 
     email = ''
@@ -366,7 +894,9 @@ def main():
 
     print 'Starting regression in %s in %s' % (branch, storage)
     print 'Results will be sent to %s' % (email)
-    result = run_regression(storage, branch, email)
+    mem = options.memory or get_memory_gb()
+    result = run_regression(storage, branch, email, options.cpus, mem,
+                            options.cache, options.cache_size, options.keep)
     if not result:
         print 'Workspace build failed'
 